@@ -1,12 +1,34 @@
 import streamlit as st
-import json
-import requests
-import base64
-from io import BytesIO
-from PIL import Image
 import time
 import re
 
+import startup  # ต้องมาก่อน import อื่น (จับเวลา cold start)
+import job_queue
+import library_store
+import thumbnails
+import artifact_store
+import hedging
+import image_select
+import tracing
+import upload_pipeline
+import output_variants
+import gemini_stream
+from library_index import page
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from helpers import (
+    clean_key, fill_template,
+    get_shopify_product_images, get_product_images_bulk,
+    cached_product, REFERENCE_ORDER,
+    decode_reference, preview_of, image_content_hash, image_size, region_preview,
+    generate_image_multi_finger, edit_generated_image, plan_reference_payload,
+    select_references,
+)
+
+# library: snapshot ในเครื่องพร้อมใช้ทันที, JSONBin โหลดใน background ระหว่างที่ผู้ใช้ใส่รหัสผ่าน
+library_store.start()
+startup.mark("imports")
+
 # --- 1. CONFIGURATION ---
 st.set_page_config(layout="wide", page_title="Ring & Jewelry AI Generator")
 
@@ -36,29 +58,54 @@ def check_password():
 
 # --- 3. ส่วนเริ่มทำงานของแอพ ---
 if not check_password():
+    startup.mark("login_page")
     st.stop()
 
-# Model ID
-MODEL_IMAGE_GEN = "models/gemini-3-pro-image-preview" # For generating images
-MODEL_SEO_GEN = "models/gemini-1.5-flash" # For generating SEO text (Fast & Cheap)
-
 # --- HELPER FUNCTIONS (คงเดิม) ---
-def clean_key(value):
-    if value is None: return ""
-    return str(value).strip().replace(" ", "").replace('"', "").replace("'", "").replace("\n", "")
+def clean_image_url(url):
+    return str(url).strip().replace(" ", "").replace("\n", "") if url else ""
+
+# รูปที่รอบนี้ยังแสดงเป็น "Loading" -> [(url, size)], poll_background_loads() rerun หน้าเมื่อโหลดเสร็จ
+loading_images = []
+BACKGROUND_POLL = 1.0  # วินาที
 
 def safe_st_image(url, width=None, caption=None):
     if not url: return
     try:
-        clean_url = str(url).strip().replace(" ", "").replace("\n", "")
+        clean_url = clean_image_url(url)
         if clean_url.startswith("http"):
-            st.image(clean_url, width=width, caption=caption)
+            # ดึงผ่าน thumbnails (ย่อ + cache ไว้ฝั่ง server) แทนการส่งรูปต้นฉบับทุก rerun
+            # ยังไม่มีใน cache -> โหลดใน background, ไม่ให้หน้าเว็บรอ
+            size = (width or 200) * 2
+            thumb = thumbnails.peek_url(clean_url, size)
+            if thumb is not None: st.image(thumb, width=width, caption=caption)
+            elif thumbnails.url_failed(clean_url): st.warning("⚠️ Image unavailable")
+            else:
+                thumbnails.fetch_later([clean_url], size)
+                loading_images.append((clean_url, size))
+                st.caption("⏳ Loading image...")
     except Exception:
         st.warning("⚠️ Image unavailable")
 
+def library_loading():
+    lib_status = library_store.status()
+    return lib_status["source"] == "default" and lib_status["refreshing"]
+
+def background_ready():
+    images = all(thumbnails.peek_url(u, s) is not None or thumbnails.url_failed(u) for u, s in loading_images)
+    return images and not library_loading()
+
+def poll_background_loads():
+    """ยังมีรูปตัวอย่าง/library ที่โหลดใน background -> เช็คทุก BACKGROUND_POLL วินาที แล้ว rerun ทั้งหน้าเมื่อพร้อม"""
+    if background_ready(): st.rerun()
+
 def reset_app_state():
     """ฟังก์ชันสำหรับล้างค่าทั้งหมดใน Form รวมทั้งรูปที่ Fetch มาจาก Shopify"""
+    artifact_store.release_session(session_id())  # คืนพื้นที่รูป/ผลลัพธ์ทั้งหมดของ session นี้
     st.session_state.generated_result = None
+    st.session_state.versions = []
+    st.session_state.current_version = None
+    st.session_state.candidates = []
     # ล้างช่อง edit prompt ด้วย
     if "result_edit_prompt" in st.session_state:
          del st.session_state["result_edit_prompt"]
@@ -69,6 +116,7 @@ def reset_app_state():
             key.startswith("var_") or 
             key.startswith("edit_prompt_area_") or # แก้ให้ตรงกับ key ที่ใช้จริง
             key.startswith("fetch_shop_") or
+            key.startswith("prep_upload_") or
             key.startswith("inp_") or 
             key == "prev_style_id"):
             keys_to_clear.append(key)
@@ -77,360 +125,143 @@ def reset_app_state():
         if key in st.session_state:
             del st.session_state[key]
 
-# --- SHOPIFY HELPERS (คงเดิม) ---
-def get_shopify_product_images(shop_url, access_token, product_id):
-    # ... (code เดิม) ...
-    shop_url = shop_url.replace("https://", "").replace("http://", "").strip()
-    if not shop_url.endswith(".myshopify.com"):
-        shop_url += ".myshopify.com"
-        
-    url = f"https://{shop_url}/admin/api/2024-01/products/{product_id}/images.json"
-    
-    headers = {
-        "X-Shopify-Access-Token": access_token,
-        "Content-Type": "application/json"
+# --- SESSION ARTIFACTS (รูปและผลลัพธ์อยู่ใน artifact_store, session_state เก็บแค่ ref) ---
+def session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "bare"
+
+def session_exists(sid):
+    """session ยังอยู่ใน session storage ของ Streamlit ไหม (websocket หลุดแต่ยัง reconnect ได้ = ยังอยู่)"""
+    manager = getattr(runtime.get_instance(), "_session_mgr", None)
+    if manager is None: return runtime.get_instance().is_active_session(sid)  # artifact_store รอ RECONNECT_TTL ก่อนคืนพื้นที่อยู่แล้ว
+    return manager.get_session_info(sid) is not None
+
+def store_images(imgs):
+    return [artifact_store.put_image(session_id(), img, image_content_hash(img)) for img in imgs]
+
+def release_refs(refs):
+    artifact_store.release(session_id(), refs)
+
+# --- VERSION HISTORY ---
+# ทุกผลลัพธ์ (generate/edit) เป็น version หนึ่ง: {"id", "parent", "ref", "kind", "prompt", "latency", "created"}
+# parent = version ที่ใช้เป็นต้นฉบับตอน edit -> แตก branch ได้, ย้อนกลับได้ทันทีโดยไม่ต้องเรียก API ใหม่
+def get_version(version_id):
+    return next((v for v in st.session_state.versions if v["id"] == version_id), None)
+
+def select_version(version_id):
+    """ใช้ version นี้เป็นรูปปัจจุบัน (ต้นฉบับของการ edit / download / upload ครั้งต่อไป)"""
+    v = get_version(version_id)
+    st.session_state.current_version = version_id if v else None
+    st.session_state.generated_result = v["ref"] if v else None
+
+def add_version(img_bytes, kind, prompt, latency, parent=None):
+    """เก็บผลลัพธ์ใหม่เป็น version ใหม่ (bytes เก็บใน artifact_store, ซ้ำกันก็เก็บครั้งเดียว) แล้วคืน id"""
+    versions = st.session_state.versions
+    v = {
+        "id": max((x["id"] for x in versions), default=0) + 1,
+        "parent": parent if get_version(parent) else None,
+        "ref": artifact_store.put_bytes(session_id(), img_bytes),
+        "kind": kind, "prompt": prompt, "latency": latency, "created": time.time(),
     }
-    
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            images_data = data.get("images", [])
-            
-            pil_images = []
-            for img_info in images_data:
-                src = img_info.get("src")
-                if src:
-                    img_resp = requests.get(src, stream=True)
-                    if img_resp.status_code == 200:
-                        img_pil = Image.open(BytesIO(img_resp.content))
-                        if img_pil.mode in ('RGBA', 'P'):
-                            img_pil = img_pil.convert('RGB')
-                        pil_images.append(img_pil)
-            return pil_images, None
-        else:
-            return None, f"Shopify Error {response.status_code}"
-    except Exception as e:
-        return None, f"Connection Error: {str(e)}"
-
-def get_target_product_details(shop_url, access_token, product_id):
-    # ... (code เดิม) ...
-    shop_url = shop_url.replace("https://", "").replace("http://", "").strip()
-    if not shop_url.endswith(".myshopify.com"): shop_url += ".myshopify.com"
-    
-    url = f"https://{shop_url}/admin/api/2024-01/products/{product_id}.json?fields=title,handle"
-    headers = {"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}
-    
-    try:
-        res = requests.get(url, headers=headers, timeout=10)
-        if res.status_code == 200:
-            p = res.json().get("product", {})
-            title = p.get("title", "")
-            handle = p.get("handle", "")
-            return title, handle
-        else:
-            return None, None
-    except Exception as e:
-        print(f"Error fetching target product: {e}")
-        return None, None
-
-def upload_image_to_shopify(shop_url, access_token, product_id, image_bytes, filename, alt_text):
-    # ... (code เดิม) ...
-    shop_url = shop_url.replace("https://", "").replace("http://", "").strip()
-    if not shop_url.endswith(".myshopify.com"): shop_url += ".myshopify.com"
-    
-    url = f"https://{shop_url}/admin/api/2024-01/products/{product_id}/images.json"
-    headers = {"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}
-    
-    # Convert bytes to base64 string
-    b64_string = base64.b64encode(image_bytes).decode('utf-8')
-    
-    payload = {
-        "image": {
-            "attachment": b64_string,
-            "filename": filename,
-            "alt": alt_text
-        }
-    }
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=20)
-        if response.status_code in [200, 201]:
-            return True, response.json()
-        else:
-            return False, f"Error {response.status_code}: {response.text}"
-    except Exception as e:
-        return False, str(e)
-
-# --- LIBRARY FUNCTIONS (คงเดิม) ---
-DEFAULT_PROMPTS = [
-    {
-        "id": "p1", "name": "Luxury Hand (Ring)", "category": "Ring",
-        "template": "High-end jewelry photography, soft studio lighting, realistic skin texture, neutral background.",
-        "variables": "",
-        "sample_url": "https://upload.wikimedia.org/wikipedia/commons/thumb/c/c2/Ring_render.jpg/320px-Ring_render.jpg"
-    }
-]
-
-def get_prompts():
-    # ... (code เดิม) ...
-    try:
-        raw_key = st.secrets.get("JSONBIN_API_KEY", "")
-        raw_bin = st.secrets.get("JSONBIN_BIN_ID", "")
-        API_KEY = clean_key(raw_key)
-        BIN_ID = clean_key(raw_bin)
-        
-        if not API_KEY or not BIN_ID: return DEFAULT_PROMPTS
-            
-        url = f"https://api.jsonbin.io/v3/b/{BIN_ID}/latest"
-        headers = {"X-Master-Key": API_KEY}
-        response = requests.get(url, headers=headers, timeout=5)
-        
-        if response.status_code == 200:
-            return response.json().get("record", DEFAULT_PROMPTS)
-        return DEFAULT_PROMPTS
-    except: return DEFAULT_PROMPTS
-
-def save_prompts(data):
-    # ... (code เดิม) ...
-    try:
-        raw_key = st.secrets.get("JSONBIN_API_KEY", "")
-        raw_bin = st.secrets.get("JSONBIN_BIN_ID", "")
-        API_KEY = clean_key(raw_key)
-        BIN_ID = clean_key(raw_bin)
-        
-        url = f"https://api.jsonbin.io/v3/b/{BIN_ID}"
-        headers = {"Content-Type": "application/json", "X-Master-Key": API_KEY}
-        requests.put(url, json=data, headers=headers, timeout=10)
-    except Exception as e: st.error(f"Save failed: {e}")
-
-# --- IMAGE HELPER (PIL to Base64) ---
-def img_to_base64(img):
-    buf = BytesIO()
-    if img.mode == 'RGBA': img = img.convert('RGB')
-    img.thumbnail((1024, 1024)) 
-    img.save(buf, format="JPEG", quality=90)
-    return base64.b64encode(buf.getvalue()).decode()
-
-# --- NEW HELPER: Bytes to Base64 String ---
-def bytes_to_base64_str(image_bytes):
-    """Helper to convert raw bytes directly to base64 string"""
-    return base64.b64encode(image_bytes).decode('utf-8')
-
-# --- AI FUNCTION: SEO (คงเดิม) ---
-def generate_seo_data(api_key, image_bytes, product_title, product_handle):
-    # ... (code เดิม) ...
-    key = clean_key(api_key)
-    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_SEO_GEN}:generateContent?key={key}"
-    
-    prompt = f"""
-    You are an SEO expert for a Jewelry E-commerce store.
-    
-    CONTEXT:
-    This image is being uploaded to a product page.
-    Target Product Name: "{product_title}"
-    Target URL Slug (Handle): "{product_handle}"
-    
-    TASK:
-    Create an SEO-friendly image filename and an Alt Text attribute specifically for this product.
-    
-    REQUIREMENTS:
-    1. filename: MUST contain the product name or handle. Use lowercase, hyphens (-) as separators. End with .jpg.
-       Example: if product is "Gold Ring", filename -> "gold-ring-model-hand.jpg"
-    2. alt_text: Describe the image naturally but MUST include the product name "{product_title}". Max 125 characters.
-    
-    OUTPUT FORMAT (JSON ONLY):
-    {{
-        "filename": "...",
-        "alt_text": "..."
-    }}
-    """
-    
-    b64_img = base64.b64encode(image_bytes).decode('utf-8')
-    
-    payload = {
-        "contents": [{
-            "parts": [
-                {"text": prompt},
-                {"inline_data": {"mime_type": "image/jpeg", "data": b64_img}}
-            ]
-        }],
-        "generationConfig": {"response_mime_type": "application/json"}
-    }
-    
-    try:
-        res = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=30)
-        if res.status_code == 200:
-            result = res.json().get("candidates", [])[0].get("content", {}).get("parts", [])[0].get("text", "{}")
-            return json.loads(result)
-        else:
-            fallback_name = f"{product_handle}-model.jpg" if product_handle else "ring-generated.jpg"
-            return {"filename": fallback_name, "alt_text": product_title or "Ring on hand"}
-    except Exception as e:
-        return {"filename": "ring-generated.jpg", "alt_text": "Ring on hand"}
-
-# --- AI FUNCTION: GENERATE FROM SCRATCH (คงเดิมจาก Logiv V2) ---
-def generate_image_multi_finger(api_key, all_images_dict, base_prompt):
-    # ... (code เดิมที่อัปเดต logic แล้ว) ...
-    key = clean_key(api_key)
-    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_IMAGE_GEN}:generateContent?key={key}"
-    
-    jewelry_locations = {
-        "index": "Index Finger (finger next to thumb)",
-        "middle": "Middle Finger (longest center finger)", 
-        "ring": "Ring Finger (finger between middle and little)",
-        "little": "Little Finger (pinky, smallest finger)",
-        "bracelet": "Wrist",
-        "necklace": "Neck"
-    }
-    
-    empty_fingers = []
-    finger_keys = ["index", "middle", "ring", "little"]
-    for f_key in finger_keys:
-        if f_key not in all_images_dict or not all_images_dict[f_key]:
-            empty_fingers.append(jewelry_locations[f_key])
-            
-    ordered_keys = ["index", "middle", "ring", "little", "bracelet", "necklace"]
-    parts = [] 
-    
-    has_necklace = "necklace" in all_images_dict and all_images_dict["necklace"]
-    framing = "Portrait/Bust shot showing Hand and Neck" if has_necklace else "Close-up Macro shot of Hand and Wrist only"
-    
-    prompt_intro = f"""
-    {base_prompt}
-    
-    IMAGE SETTING:
-    - TYPE: Professional Jewelry Photography
-    - FRAMING: {framing}
-    - SUBJECT: A single female model.
-    """
-    
-    positive_instructions = []
-    image_global_index = 1
-    
-    for item_key in ordered_keys:
-        if item_key in all_images_dict and all_images_dict[item_key]:
-            imgs = all_images_dict[item_key]
-            count = len(imgs)
-            loc_name = jewelry_locations[item_key]
-            
-            if count == 1:
-                ref_text = f"reference image #{image_global_index}"
-                image_global_index += 1
+    versions.append(v)
+    select_version(v["id"])
+    return v["id"]
+
+def version_label(v):
+    origin = f" ← v{v['parent']}" if v["parent"] else ""
+    return f"v{v['id']}{origin} · {v['kind']}: {v['prompt'].strip()[:50]} · {v['latency']:.0f}s"
+
+def current_result():
+    ref = st.session_state.get("generated_result")
+    return artifact_store.get(ref) if ref else None
+
+def prepare_uploads(item_key, uploaded_files):
+    """decode ไฟล์ที่อัปโหลดแค่ครั้งเดียวต่อ file_id (ย่อเหลือ 1024px) แล้วใช้ซ้ำทุก rerun"""
+    prep_key = f"prep_upload_{item_key}"
+    prepared = st.session_state.get(prep_key, {})
+    current = {}
+    for f in uploaded_files:
+        current[f.file_id] = prepared[f.file_id] if f.file_id in prepared else store_images([decode_reference(f)])[0]
+    # ไฟล์ที่ถูกเอาออกจาก uploader -> คืนพื้นที่
+    release_refs([ref for file_id, ref in prepared.items() if file_id not in current])
+    st.session_state[prep_key] = current
+    return artifact_store.get_many(current.values())
+
+def drop_prepared_uploads(item_key):
+    prepared = st.session_state.pop(f"prep_upload_{item_key}", None)
+    if prepared: release_refs(list(prepared.values()))
+
+# --- BACKGROUND JOBS ---
+MAX_TRACKED_JOBS = 10
+LIBRARY_PAGE_SIZE = 20   # template ต่อหน้าใน Library Manager
+
+def candidate_options(style):
+    """การตั้งค่า hedging ของ style: ยิงพร้อมกันกี่ request และเก็บทั้งหมดเป็น gallery หรือไม่"""
+    return {"candidates": int(style.get("candidates") or 1), "gallery": style.get("candidate_mode") == "gallery"}
+
+def submit_job(fn, *args, kind, label, **kwargs):
+    """ส่งงานเข้า job_queue แล้วจำ job id ไว้ใน session + URL (refresh แล้วยังตามงานต่อได้)"""
+    job_id = job_queue.submit(fn, *args, kind=kind, label=label, **kwargs)
+    st.session_state.jobs = (st.session_state.jobs + [job_id])[-MAX_TRACKED_JOBS:]
+    st.query_params["job"] = st.session_state.jobs
+    return job_id
+
+UPLOAD_STAGE_ICONS = {upload_pipeline.PENDING: "🕒", upload_pipeline.SEO: "🧠", upload_pipeline.UPLOADING: "☁️",
+                      upload_pipeline.DONE: "✅", upload_pipeline.FAILED: "❌"}
+
+def progress_note(progress):
+    """สถานะของ Gemini stream ระหว่างรอ: ยังไม่ได้ byte แรก / ได้มาแล้วกี่ KB (+ ข้อความจาก model ถ้ามี)"""
+    if not progress: return ""
+    if progress["stage"] == gemini_stream.WAITING: return " · waiting for Gemini"
+    note = f" · first byte {progress['ttfb']:.1f}s · {progress['bytes'] / 1024:,.0f} KB received"
+    if progress["text"]: note += f" · 💬 {progress['text'][-80:]}"
+    return note
+
+def render_jobs_panel():
+    """แสดงสถานะงานที่กำลังรัน และเอาผลลัพธ์ของงานที่เสร็จแล้วมาใส่ generated_result"""
+    jobs = [j for j in (job_queue.get(job_id) for job_id in st.session_state.jobs) if j]
+    if not jobs: return
+
+    finished = [j for j in jobs if not j.active and j.id not in st.session_state.applied_jobs]
+    for job in sorted(finished, key=lambda j: j.finished):
+        st.session_state.applied_jobs.add(job.id)
+        if job.status == job_queue.DONE and job.kind != "upload":
+            results = job.result if isinstance(job.result, list) else [job.result]  # list = gallery ของ candidates
+            if results:
+                ids = [add_version(img, job.kind, job.meta.get("prompt", ""), job.elapsed(), job.meta.get("parent")) for img in results]
+                select_version(ids[0])
+                st.session_state.candidates = ids if len(ids) > 1 else []
+                output_variants.warm(results[0])  # เตรียม JPEG/WebP สำหรับ download/upload ไว้ล่วงหน้า
+    if finished:
+        st.rerun()
+
+    with st.expander(f"⏳ Jobs ({sum(j.active for j in jobs)} running)", expanded=any(j.active for j in jobs)):
+        for job in reversed(jobs):
+            if job.status == job_queue.QUEUED:
+                st.caption(f"🕒 {job.label} · queued")
+            elif job.status == job_queue.RUNNING:
+                st.caption(f"🎨 {job.label} · running {job.elapsed():.0f}s" + progress_note(job.meta.get("progress")))
+            elif job.status == job_queue.DONE:
+                st.caption(f"✅ {job.label} · done in {job.elapsed():.0f}s" + (f" · ⚠️ {job.error}" if job.error else ""))
             else:
-                ref_text = f"reference images #{image_global_index} to #{image_global_index + count - 1}"
-                image_global_index += count
-            
-            instruction = f"   * {loc_name.upper()}: WEARING the jewelry design shown in {ref_text}."
-            positive_instructions.append(instruction)
-            
-            for img in imgs:
-                parts.append({"inline_data": {"mime_type": "image/jpeg", "data": img_to_base64(img)}})
-
-    negative_instructions = []
-    if empty_fingers:
-        empty_list_str = ", ".join(empty_fingers)
-        negative_instructions.append(f"   * The following fingers MUST BE BARE (No Rings): {empty_list_str}.")
-    
-    negative_instructions.append("   * Do NOT put rings on the Thumb.")
-    negative_instructions.append("   * Do NOT duplicate items.")
-    
-    full_prompt_text = f"""
-    {prompt_intro}
-
-    --- MANDATORY PLACEMENT INSTRUCTIONS ---
-    Please strictly follow these assignments. Do not shift jewelry to other positions.
-
-    ACTIVE ZONES (WEAR JEWELRY HERE):
-    {chr(10).join(positive_instructions)}
-
-    EMPTY ZONES (NO JEWELRY HERE):
-    {chr(10).join(negative_instructions)}
-
-    --- QUALITY GUIDELINES ---
-    1. Realistic skin texture and lighting.
-    2. Jewelry details (gemstones, metal) must match references exactly.
-    3. Anatomically correct hand pose.
-    """
-
-    parts.insert(0, {"text": full_prompt_text})
-    
-    try:
-        res = requests.post(
-            url, 
-            json={
-                "contents": [{"parts": parts}], 
-                "generationConfig": {"temperature": 0.15} 
-            }, 
-            headers={"Content-Type": "application/json"},
-            timeout=60
-        )
-        
-        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
-            
-        content = res.json().get("candidates", [])[0].get("content", {}).get("parts", [])[0]
-        
-        if "inline_data" in content: return base64.b64decode(content["inline_data"]["data"]), None
-        if "inlineData" in content: return base64.b64decode(content["inlineData"]["data"]), None
-        if "text" in content: return None, f"Model returned text: {content['text']}"
-            
-        return None, "Unknown format"
-    except Exception as e: return None, str(e)
-
-# --- NEW AI FUNCTION: EDIT EXISTING IMAGE ---
-def edit_generated_image(api_key, current_image_bytes, edit_instructions):
-    """ฟังก์ชันสำหรับแก้ไขภาพเดิมตามคำสั่งใหม่"""
-    key = clean_key(api_key)
-    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_IMAGE_GEN}:generateContent?key={key}"
-    
-    # แปลง bytes ภาพปัจจุบันเป็น base64 string
-    base64_img = bytes_to_base64_str(current_image_bytes)
-
-    # สร้าง Prompt สำหรับการแก้ไข
-    edit_prompt = f"""
-    Based on the provided image, perform the following modification:
-    {edit_instructions}
-
-    IMPORTANT:
-    - Maintain professional jewelry photography style, lighting, and high realism as seen in the original image.
-    - Keep all other elements of the original image intact unless specified otherwise by the instructions.
-    - Ensure anatomically correct hand structure if moving rings.
-    """
-
-    # สร้าง Payload (รูปเดิม + คำสั่งแก้ไข)
-    parts = [
-        {"text": edit_prompt},
-        {"inline_data": {"mime_type": "image/jpeg", "data": base64_img}}
-    ]
-    
-    try:
-        # ใช้ temperature ต่ำๆ เพื่อให้คงสภาพเดิมไว้ให้มากที่สุด
-        res = requests.post(
-            url, 
-            json={
-                "contents": [{"parts": parts}], 
-                "generationConfig": {"temperature": 0.1} 
-            }, 
-            headers={"Content-Type": "application/json"},
-            timeout=60
-        )
-        
-        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
-            
-        content = res.json().get("candidates", [])[0].get("content", {}).get("parts", [])[0]
-        
-        if "inline_data" in content: return base64.b64decode(content["inline_data"]["data"]), None
-        if "inlineData" in content: return base64.b64decode(content["inlineData"]["data"]), None
-        if "text" in content: return None, f"Model returned text: {content['text']}"
-            
-        return None, "Unknown format"
-    except Exception as e: return None, str(e)
-
+                st.caption(f"❌ {job.label} · {job.error}")
+            for pid, t in job.meta.get("targets", {}).items():
+                st.caption(f"　{UPLOAD_STAGE_ICONS[t['stage']]} {pid} {t['title']} · "
+                           + (t["error"] or (f"`{t['filename']}`" if t["filename"] else t["stage"])))
 
 # --- SESSION STATE INIT ---
-if "library" not in st.session_state: st.session_state.library = get_prompts()
+# index ของ library กลางทั้ง process -> สร้างใหม่เฉพาะเมื่อ version เปลี่ยน, ไม่ copy ต่อ session
+library = library_store.index()
+startup.mark("library", source=library_store.status()["source"])
 if "generated_result" not in st.session_state: st.session_state.generated_result = None
+if "versions" not in st.session_state: st.session_state.versions = []
+if "current_version" not in st.session_state: st.session_state.current_version = None
+if "candidates" not in st.session_state: st.session_state.candidates = []
+artifact_store.touch(session_id(), session_exists if runtime.exists() else None)
 if "edit_target" not in st.session_state: st.session_state.edit_target = None
+if "jobs" not in st.session_state:
+    st.session_state.jobs = [j for j in st.query_params.get_all("job") if job_queue.get(j)]
+if "applied_jobs" not in st.session_state: st.session_state.applied_jobs = set()
 
 # --- SIDEBAR CONFIG ---
 with st.sidebar:
@@ -456,6 +287,39 @@ with st.sidebar:
     
     if "JSONBIN_API_KEY" in st.secrets: st.caption("✅ Database Connected")
     else: st.warning("⚠️ Local Mode")
+    lib_status = library_store.status()
+    if lib_status["pending"]: st.caption("💾 Saving library...")
+    if library_loading(): st.caption("⏳ Loading library...")
+    if lib_status["last_error"]: st.warning(f"⚠️ Library sync failed: {lib_status['last_error']}")
+    if lib_status["conflicts"]: st.info(f"🔀 Merged concurrent edits, kept yours for: {', '.join(lib_status['conflicts'])}")
+    
+    mem = artifact_store.usage()
+    st.caption(f"🧠 Session data: {mem['memory_bytes'] / 2**20:.0f}/{mem['memory_budget'] / 2**20:.0f} MB RAM, "
+               f"{mem['disk_bytes'] / 2**20:.0f} MB on disk · {mem['sessions']} sessions")
+    
+    use_result_cache = st.toggle("♻️ Reuse cached results", value=True, help="Generate/Edit ที่ input เหมือนเดิมทุกอย่างจะได้รูปเดิมจาก cache ทันที ไม่เสียค่า API ซ้ำ")
+    skip_duplicates = st.toggle("🧹 Skip near-duplicate images", value=True, help="ไม่ส่งรูปที่แทบเหมือนกัน (มุมเดิม, สีต่างกัน) เป็น reference ซ้ำ")
+    max_refs_per_slot = st.number_input("🖼️ Max images per slot (0 = all)", min_value=0, max_value=20,
+                                        value=image_select.MAX_PER_SLOT, help="เกินจำนวนนี้จะเลือกเฉพาะรูปที่ต่างกันมากที่สุด")
+    
+    with st.expander("⏱️ Performance"):
+        st.caption("🚀 Startup: " + " · ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup.report())
+                   + f" · library from {lib_status['source']}")
+        perf = tracing.summary()
+        # st.dataframe import pandas/pyarrow (~0.7s) -> สร้างตารางเมื่อเปิดดูเท่านั้น
+        if perf and st.toggle("📊 Show call stats", key="perf_table"):
+            st.dataframe([{
+                "call": r["span"], "n": r["count"],
+                "p50 s": round(r["p50"], 2), "p95 s": round(r["p95"], 2), "p99 s": round(r["p99"], 2),
+                "out KB": round(r["request_bytes"] / r["count"] / 1024), "in KB": round(r["response_bytes"] / r["count"] / 1024),
+                "retries": r["retries"], "errors": r["errors"],
+            } for r in perf], hide_index=True, use_container_width=True)
+            st.caption(f"p50/p95/p99 จาก {tracing.WINDOW} ครั้งล่าสุดต่อ call · KB = ค่าเฉลี่ยต่อ call")
+            dl_col1, dl_col2 = st.columns(2)
+            dl_col1.download_button("JSONL", tracing.export_jsonl(), file_name="traces.jsonl", mime="application/x-ndjson")
+            dl_col2.download_button("Prometheus", tracing.export_prometheus(), file_name="metrics.prom", mime="text/plain")
+        elif not perf:
+            st.caption("ยังไม่มีการเรียก API ใน process นี้")
 
 # --- MAIN UI ---
 st.title("💍 Ring & Jewelry AI Generator")
@@ -469,17 +333,20 @@ with tab1:
     # --- STEP 1: SELECT STYLE ---
     st.subheader("1️⃣ Select Style Template")
     
-    lib = st.session_state.library
-    ring_prompts = [p for p in lib if p.get('category') == 'Ring']
-    
-    if not ring_prompts:
+    if not library.by_category.get("Ring"):
         st.error("❌ No Ring templates found.")
         st.stop()
     
     col_style1, col_style2 = st.columns([2, 1])
     
     with col_style1:
-        selected_style = st.selectbox("Choose Style", ring_prompts, format_func=lambda x: x.get('name', 'Unknown'), key="style_select")
+        style_query = st.text_input("🔎 Find style", key="style_query", placeholder="name, prompt or variable")
+        ring_ids = library.search(style_query, category="Ring")
+        if not ring_ids:
+            st.warning(f"No Ring templates match '{style_query}'")
+            ring_ids = library.by_category["Ring"]
+        style_id = st.selectbox("Choose Style", ring_ids, format_func=lambda i, lib=library: lib.get(i).get('name', 'Unknown'), key="style_select")
+        selected_style = library.get(style_id)
         
         template_text = selected_style.get('template', '')
         vars_list = [v.strip() for v in selected_style.get('variables', '').split(",") if v.strip()]
@@ -491,9 +358,7 @@ with tab1:
             for i, v in enumerate(vars_list):
                 user_vals[v] = cols[i].text_input(v, key=f"var_{selected_style['id']}_{v}")
         
-        final_base_prompt = template_text
-        for k, v in user_vals.items():
-            final_base_prompt = final_base_prompt.replace(f"{{{k}}}", v)
+        final_base_prompt = fill_template(template_text, user_vals)
         
         st.write("**Preview & Edit Prompt:**")
         prompt_key = f"edit_prompt_area_{selected_style['id']}"
@@ -522,6 +387,8 @@ with tab1:
                 if sh_shop and sh_token:
                     c_id, c_btn = st.columns([2, 1])
                     prod_id = c_id.text_input("Shopify ID", placeholder="ID", key=f"inp_{item_key}", label_visibility="collapsed")
+                    product = cached_product(sh_shop, prod_id) if prod_id else None
+                    if product: st.caption(f"🏷️ {product['title']}")
                     
                     if c_btn.button("Fetch", key=f"btn_{item_key}"):
                         if not prod_id:
@@ -530,10 +397,12 @@ with tab1:
                             with st.spinner(".."):
                                 imgs, err = get_shopify_product_images(sh_shop, sh_token, prod_id)
                                 if imgs:
-                                    st.session_state[fetch_key] = imgs
+                                    release_refs(st.session_state[fetch_key])
+                                    st.session_state[fetch_key] = store_images(imgs)
                                     st.success("✅")
+                                    if err: st.warning(f"⚠️ {err}")
                                 else:
-                                    st.error("❌")
+                                    st.error(f"❌ {err or 'No images'}")
                 
                 # Manual Upload
                 uploaded_files = st.file_uploader(
@@ -544,22 +413,30 @@ with tab1:
                 # Combine & Display
                 current_images = []
                 if st.session_state[fetch_key]:
-                    current_images.extend(st.session_state[fetch_key])
+                    current_images.extend(artifact_store.get_many(st.session_state[fetch_key]))
                     st.info(f"Shopify: {len(st.session_state[fetch_key])}")
                     if st.button("Clear Fetch", key=f"clr_{item_key}"):
+                        release_refs(st.session_state[fetch_key])
                         st.session_state[fetch_key] = []
                         st.rerun()
                 
                 if uploaded_files:
-                    current_images.extend([Image.open(f) for f in uploaded_files])
+                    current_images.extend(prepare_uploads(item_key, uploaded_files))
+                else:
+                    drop_prepared_uploads(item_key)
                 
-                # Return images for main dict
+                # Return images for main dict (เฉพาะรูปที่ผ่านการคัด)
                 if current_images:
-                    st.caption(f"✅ {len(current_images)} images")
+                    selected, dropped = select_references(current_images, max_refs_per_slot, skip_duplicates)
+                    if dropped:
+                        st.caption(f"✅ {len(selected)} of {len(current_images)} images used")
+                    else:
+                        st.caption(f"✅ {len(current_images)} images")
                     thumb_cols = st.columns(min(3, len(current_images)))
                     for i, img in enumerate(current_images):
-                        thumb_cols[i % 3].image(img, use_column_width=True)
-                    return current_images
+                        thumb_cols[i % 3].image(preview_of(img), use_column_width=True,
+                                                caption=f"⏭️ {dropped[i]}" if i in dropped else None)
+                    return selected
                 else:
                     st.caption("⚪ Empty")
                     return []
@@ -567,6 +444,23 @@ with tab1:
     # --- STEP 2: RINGS INPUT ---
     st.subheader("2️⃣ Fingers (Rings)")
     
+    # --- FETCH ALL: ทุก slot ที่ใส่ ID ไว้ -> metadata query เดียว + โหลดรูปใน pool เดียว ---
+    if sh_shop and sh_token:
+        slot_ids = {slot: st.session_state.get(f"inp_{slot}", "").strip() for slot in REFERENCE_ORDER}
+        slot_ids = {slot: pid for slot, pid in slot_ids.items() if pid}
+        if st.button("⚡ Fetch all", disabled=not slot_ids, help="Fetch every slot that has a Shopify ID"):
+            with st.spinner(f"Fetching {len(slot_ids)} products..."):
+                galleries = get_product_images_bulk(sh_shop, sh_token, list(slot_ids.values()))
+            for slot, pid in slot_ids.items():
+                imgs, err = galleries.get(pid, (None, "Product not found"))
+                fetch_key = f"fetch_shop_{slot}"
+                if imgs:
+                    release_refs(st.session_state.get(fetch_key, []))
+                    st.session_state[fetch_key] = store_images(imgs)
+                    if err: st.warning(f"⚠️ {slot.capitalize()}: {err}")
+                else:
+                    st.error(f"❌ {slot.capitalize()}: {err or 'No images'}")
+    
     fingers = [
         {"key": "index", "name": "Index Finger", "emoji": "☝️"},
         {"key": "middle", "name": "Middle Finger", "emoji": "🖕"},
@@ -615,6 +509,7 @@ with tab1:
             st.success(f"✅ Ready: {total_items} jewelry items assigned.")
             item_list = ", ".join([k.capitalize() for k in all_jewelry_images.keys()])
             st.caption(f"📍 Items: {item_list}")
+            st.caption(f"📦 Payload: {plan_reference_payload(all_jewelry_images).summary()}")
         else:
             st.warning("⚠️ Assign at least one item (ID or Upload)")
     
@@ -622,29 +517,85 @@ with tab1:
         can_generate = bool(all_jewelry_images) and bool(api_key)
         
         if st.button("🚀 GENERATE PHOTO", type="primary", use_container_width=True, disabled=not can_generate):
-            with st.spinner("🎨 Generating jewelry photo..."):
-                img_bytes, error = generate_image_multi_finger(api_key, all_jewelry_images, user_edited_prompt)
-                
-                if img_bytes:
-                    st.session_state.generated_result = img_bytes
-                    st.success("✅ Done!")
-                    st.rerun()
-                else:
-                    st.error(f"❌ Failed: {error}")
+            # รันใน background -> หน้าเว็บไม่ค้าง และกด generate ชุดต่อไปได้เลย
+            progress = gemini_stream.new_progress()
+            submit_job(generate_image_multi_finger, api_key, all_jewelry_images, user_edited_prompt,
+                       kind="generate", label=f"Generate: {', '.join(all_jewelry_images.keys())}",
+                       meta={"prompt": user_edited_prompt, "progress": progress}, progress=progress,
+                       use_cache=use_result_cache, force_regenerate=st.session_state.get("force_regenerate", False),
+                       **candidate_options(selected_style))
+            st.toast("🎨 Generation queued")
+        
+        st.checkbox("♻️ Force regenerate", key="force_regenerate", help="ไม่ใช้ผลลัพธ์เดิมจาก cache แม้ reference + prompt จะเหมือนเดิม")
         
         if st.button("🔄 Reset / Clear All", use_container_width=True, on_click=reset_app_state):
             pass
     
+    # --- JOB STATUS (poll ทุก 2 วินาทีระหว่างที่ยังมีงานค้าง) ---
+    has_active_jobs = any(j.active for j in (job_queue.get(job_id) for job_id in st.session_state.jobs) if j)
+    st.fragment(run_every=2 if has_active_jobs else None)(render_jobs_panel)()
+    
     # --- DISPLAY RESULT & EDIT SECTION (NEW) ---
-    if st.session_state.generated_result:
+    result_bytes = current_result()
+    if result_bytes:
         st.divider()
         st.subheader("✨ Generated Result")
         
+        # --- CANDIDATES: เลือกรูปที่ดีที่สุดจากงานที่ยิงหลาย request ---
+        candidate_ids = [vid for vid in st.session_state.candidates if get_version(vid)]
+        if candidate_ids:
+            st.caption("🎯 Pick the best candidate")
+            for col, vid in zip(st.columns(len(candidate_ids)), candidate_ids):
+                v = get_version(vid)
+                col.image(thumbnails.for_bytes(artifact_store.get(v["ref"]), content_hash=v["ref"]), use_column_width=True)
+                picked_now = vid == st.session_state.current_version
+                if col.button("✅ Selected" if picked_now else f"Use v{vid}", key=f"cand_{vid}", disabled=picked_now, use_container_width=True):
+                    select_version(vid)
+                    st.rerun()
+        
+        # --- VERSIONS: เลือก/ย้อนกลับ/เทียบ ---
+        versions = st.session_state.versions
+        if versions:
+            labels = {v["id"]: version_label(v) for v in reversed(versions)}
+            ids = list(labels)
+            picked = st.selectbox(
+                "🕘 Version (ใช้เป็นต้นฉบับของ Edit / Download / Upload)", ids,
+                index=ids.index(st.session_state.current_version) if st.session_state.current_version in ids else 0,
+                format_func=labels.get,
+            )
+            if picked != st.session_state.current_version:
+                select_version(picked)
+                st.rerun()
+            compare_ids = [vid for vid in ids if vid != picked]
+            compare_with = st.selectbox("🔍 Compare with", [None] + compare_ids,
+                                        format_func=lambda vid: "—" if vid is None else labels[vid])
+        else:
+            compare_with = None
+        
         # แสดงรูปภาพผลลัพธ์
-        st.image(st.session_state.generated_result, use_column_width=True, caption="Current Generated Image")
+        if compare_with:
+            cmp_col1, cmp_col2 = st.columns(2)
+            cmp_col1.image(result_bytes, use_column_width=True, caption=f"v{st.session_state.current_version} (current)")
+            cmp_col2.image(artifact_store.get(get_version(compare_with)["ref"]), use_column_width=True, caption=f"v{compare_with}")
+        else:
+            st.image(result_bytes, use_column_width=True, caption="Current Generated Image")
         
         # --- ส่วนแก้ไขรูปภาพ (NEW SECTION) ---
         st.markdown("### 🎨 Edit This Image")
+        # โหมด region: ส่งเฉพาะส่วนที่เลือกให้ Gemini แล้วผสมกลับ -> ส่วนอื่นของรูปไม่เปลี่ยนเลย
+        region, region_error = None, None
+        if st.toggle("🎯 Edit a region only", key="edit_region_on", help="Only the marked area is sent and re-rendered; the rest stays pixel-identical"):
+            region_col1, region_col2 = st.columns([2, 1])
+            xs = region_col1.slider("Left → Right (%)", 0, 100, (30, 70), key="edit_region_x")
+            ys = region_col1.slider("Top → Bottom (%)", 0, 100, (30, 70), key="edit_region_y")
+            width, height = image_size(result_bytes)
+            region = (xs[0] * width / 100, ys[0] * height / 100, xs[1] * width / 100, ys[1] * height / 100)
+            try:
+                region_col2.image(region_preview(result_bytes, region), caption="🟥 edited · 🟨 context sent")
+            except ValueError as e:
+                # region ใช้ไม่ได้ -> ปิดปุ่ม Apply แทนที่จะแอบส่งทั้งรูป
+                region_error = str(e)
+                region_col2.warning(f"⚠️ {e}")
         edit_col1, edit_col2 = st.columns([3, 1])
         
         with edit_col1:
@@ -658,83 +609,60 @@ with tab1:
         with edit_col2:
             st.write("") # Spacer
             st.write("") # Spacer
-            if st.button("🔄 Apply Edits", type="primary", use_container_width=True, disabled=not edit_instructions):
-                with st.spinner("🎨 Applying edits to image..."):
-                    # เรียกฟังก์ชันแก้ไข โดยส่งรูปล่าสุด + คำสั่งแก้ไขไป
-                    new_img_bytes, edit_error = edit_generated_image(
-                        api_key, 
-                        st.session_state.generated_result, 
-                        edit_instructions
-                    )
-                    
-                    if new_img_bytes:
-                        # อัปเดตผลลัพธ์ด้วยรูปใหม่
-                        st.session_state.generated_result = new_img_bytes
-                        st.success("✅ Edits Applied!")
-                        st.rerun() # รีเฟรชหน้าจอเพื่อแสดงรูปใหม่
-                    else:
-                        st.error(f"❌ Edit Failed: {edit_error}")
+            if st.button("🔄 Apply Edits", type="primary", use_container_width=True, disabled=not edit_instructions or region_error is not None):
+                # ส่งรูปล่าสุด + คำสั่งแก้ไขเข้า queue, ผลลัพธ์จะมาแทน generated_result เมื่อเสร็จ
+                progress = gemini_stream.new_progress()
+                submit_job(edit_generated_image, api_key, result_bytes, edit_instructions,
+                           kind="edit", label=f"Edit{' (region)' if region else ''}: {edit_instructions[:40]}",
+                           region=region, progress=progress,
+                           meta={"prompt": edit_instructions, "parent": st.session_state.current_version, "progress": progress},
+                           use_cache=use_result_cache, force_regenerate=st.session_state.get("force_regenerate", False),
+                           **candidate_options(selected_style))
+                st.rerun()
 
         st.divider()
         
         # --- DOWNLOAD & UPLOAD SECTION ---
+        # variant (format + ความกว้าง) ที่ใช้ทั้งตอน download และ upload, ขนาดแสดงเมื่อ encode เสร็จแล้ว
+        variant_labels = {}
+        for name in output_variants.names_for(image_size(result_bytes)):
+            encoded = output_variants.cached(result_bytes, name)
+            variant_labels[name] = f"{name} · {len(encoded) / 1024:,.0f} KB" if encoded else f"{name} · …"
+        variant = st.selectbox("🗜️ Output format", list(variant_labels), index=0, format_func=variant_labels.get, key="output_variant",
+                               help="progressive JPEG / WebP ที่ย่อให้ไม่เกินขนาดเป้าหมาย, original = ไฟล์จาก Gemini ตามเดิม")
         col_dl, col_up = st.columns([1, 2])
         
         with col_dl:
             st.markdown("### 💾 Download")
+            with st.spinner("🗜️ Encoding..."):
+                variant_bytes = output_variants.get(result_bytes, variant)
             st.download_button(
                 "📥 Download Image",
-                st.session_state.generated_result,
-                "jewelry_gen.jpg",
-                "image/jpeg",
+                variant_bytes,
+                f"jewelry_gen.{output_variants.extension(variant, result_bytes)}",
+                output_variants.mime_type(variant, result_bytes),
                 use_container_width=True,
                 type="secondary"
             )
             
         with col_up:
             st.markdown("### ☁️ Upload to Shopify")
-            target_upload_id = st.text_input("Target Product ID", key="target_upload_id", placeholder="Ex: 8234...", help="ID ของสินค้าปลายทางที่จะเอารูปนี้ไปใส่")
+            target_upload_ids = upload_pipeline.split_ids(st.text_input(
+                "Target Product IDs", key="target_upload_id", placeholder="Ex: 8234..., 8235...",
+                help="ID ของสินค้าปลายทางที่จะเอารูปนี้ไปใส่ (หลาย ID คั่นด้วย comma / เว้นวรรค)"))
             
-            if st.button("⬆️ Generate SEO & Upload", type="primary", use_container_width=True, disabled=not target_upload_id):
-                
-                with st.spinner(f"🔍 Fetching details for Product ID: {target_upload_id}..."):
-                    t_title, t_handle = get_target_product_details(sh_shop, sh_token, target_upload_id)
-                
-                if not t_title:
-                    st.error("❌ Product ID Not Found in Shopify.")
-                else:
-                    with st.spinner(f"🧠 Generating SEO for '{t_title}'..."):
-                        seo_data = generate_seo_data(
-                            api_key, 
-                            st.session_state.generated_result, 
-                            t_title, 
-                            t_handle
-                        )
-                        final_filename = seo_data.get("filename", f"{t_handle}.jpg")
-                        final_alt = seo_data.get("alt_text", t_title)
-                        
-                        st.info(f"📄 File: `{final_filename}`\n🏷️ Alt: `{final_alt}`")
-                    
-                    with st.spinner("☁️ Uploading..."):
-                        success, resp = upload_image_to_shopify(
-                            sh_shop, sh_token, 
-                            target_upload_id, 
-                            st.session_state.generated_result, 
-                            final_filename, 
-                            final_alt
-                        )
-                        
-                        if success:
-                            st.success(f"✅ Uploaded Successfully to '{t_title}'!")
-                            time.sleep(1)
-                        else:
-                            st.error(f"❌ Upload Failed: {resp}")
+            if st.button("⬆️ Generate SEO & Upload", type="primary", use_container_width=True, disabled=not target_upload_ids):
+                # details -> SEO -> upload ของทุก target ใน background, สถานะแต่ละตัวดูได้ใน Jobs
+                targets = upload_pipeline.new_status(target_upload_ids)
+                submit_job(upload_pipeline.upload_to_targets, api_key, sh_shop, sh_token, result_bytes, target_upload_ids, targets,
+                           variant=variant, kind="upload", label=f"Upload to {len(target_upload_ids)} product(s)", meta={"targets": targets})
+                st.toast("☁️ Upload queued")
 
 
 # ============= TAB 2: LIBRARY MANAGER =============
 with tab2:
     st.subheader("📚 Prompt Library Manager")
-    target = st.session_state.edit_target
+    target = library.get(st.session_state.edit_target) if st.session_state.edit_target else None
     title = f"✏️ Edit: {target['name']}" if target else "➕ Add New Template"
     
     with st.form("lib_form", border=True):
@@ -746,29 +674,55 @@ with tab2:
         c3, c4 = st.columns(2)
         v = c3.text_input("Vars", value=target['variables'] if target else "")
         u = c4.text_input("Sample URL", value=target['sample_url'] if target else "")
+        c5, c6 = st.columns(2)
+        k = c5.number_input("Parallel requests", min_value=1, max_value=hedging.MAX_CANDIDATES,
+                            value=int(target.get('candidates') or 1) if target else 1,
+                            help="ยิง Generate/Edit พร้อมกันหลาย request เพื่อลดเวลารอ (เสียค่า API ตามจำนวน)")
+        modes = {"first": "Use the first image", "gallery": "Pick from a gallery"}
+        m = c6.selectbox("With several requests", list(modes), format_func=modes.get,
+                         index=list(modes).index(target.get('candidate_mode', 'first')) if target else 0)
         
         cols = st.columns([1, 1, 3])
         if cols[0].form_submit_button("💾 Save", type="primary"):
-            new = {"id": target['id'] if target else str(len(st.session_state.library)+1000), "name": n, "category": c, "template": t, "variables": v, "sample_url": u}
-            if target:
-                for idx, item in enumerate(st.session_state.library):
-                    if item['id'] == target['id']: st.session_state.library[idx] = new; break
-            else: st.session_state.library.append(new)
-            save_prompts(st.session_state.library)
+            # template ใหม่ไม่มี id -> library_store สุ่ม id ที่ไม่ซ้ำให้
+            new = {"id": target['id'] if target else None, "name": n, "category": c, "template": t, "variables": v, "sample_url": u, "candidates": int(k), "candidate_mode": m}
+            library_store.upsert_template(new)
             st.session_state.edit_target = None; st.rerun()
         
         if target and cols[1].form_submit_button("❌ Cancel"):
             st.session_state.edit_target = None; st.rerun()
     
     st.divider()
-    for i, p in enumerate([x for x in st.session_state.library if x.get('category') == 'Ring']):
+    f1, f2 = st.columns([3, 1])
+    lib_query = f1.text_input("🔎 Search templates", key="lib_query", placeholder="name, category, prompt or variable")
+    categories = ["All"] + library.categories
+    lib_category = f2.selectbox("Category", categories, index=categories.index("Ring") if "Ring" in categories else 0, key="lib_category")
+    found = library.search(lib_query, category=None if lib_category == "All" else lib_category)
+    # render เฉพาะหน้าที่เปิดอยู่ -> เวลาเปิด tab ไม่ขึ้นกับขนาด library
+    pages = max(1, -(-len(found) // LIBRARY_PAGE_SIZE))
+    if st.session_state.get("lib_page", 1) > pages: st.session_state.lib_page = pages  # ผลค้นหาน้อยลง
+    p1, p2 = st.columns([1, 3])
+    page_no = p1.number_input("Page", min_value=1, max_value=pages, value=1, key="lib_page")
+    rows, _ = page(found, page_no, LIBRARY_PAGE_SIZE)
+    p2.caption(f"{len(found)} of {len(library)} templates · page {page_no}/{pages}")
+    thumbnails.fetch_later([clean_image_url(library.get(i).get("sample_url")) for i in rows], size=120)
+    for template_id in rows:
+        p = library.get(template_id)
         c1, c2, c3, c4 = st.columns([1, 4, 1, 1])
         if p.get("sample_url"):
             with c1: safe_st_image(p["sample_url"], width=60)
-        c2.write(f"**{p.get('name')}**"); c2.caption(f"Vars: {p.get('variables')}")
-        if c3.button("✏️", key=f"e{i}"): st.session_state.edit_target = p; st.rerun()
-        if c4.button("🗑️", key=f"d{i}"): st.session_state.library.remove(p); save_prompts(st.session_state.library); st.rerun()
+        c2.write(f"**{p.get('name')}**"); c2.caption(f"{p.get('category')} · Vars: {p.get('variables')}")
+        if c3.button("✏️", key=f"e_{template_id}"): st.session_state.edit_target = template_id; st.rerun()
+        if c4.button("🗑️", key=f"d_{template_id}"):
+            library_store.delete_template(template_id)
+            if st.session_state.edit_target == template_id: st.session_state.edit_target = None
+            st.rerun()
         st.divider()
 
 st.markdown("---")
 st.caption("💎 Powered by Gemini AI")
+
+if loading_images or library_loading():
+    st.fragment(run_every=BACKGROUND_POLL)(poll_background_loads)()
+
+startup.mark("first_run")
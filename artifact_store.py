@@ -0,0 +1,200 @@
+"""Per-process store for the large things sessions hold: reference images and results.
+
+Sessions keep only a content-hash reference in st.session_state; the data lives
+here, deduplicated across sessions. Items are kept in RAM up to MEMORY_BUDGET
+(LRU). Colder items spill to a temp directory and are loaded back on access.
+An item is deleted once no session references it any more, that is after
+release_session() (reset, or a session that ended / has been idle too long).
+"""
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+MEMORY_BUDGET = int(os.environ.get("ARTIFACT_MEMORY_MB", "512")) * 1024 * 1024
+SESSION_IDLE_TTL = 2 * 60 * 60   # วินาที: session ที่ไม่มี rerun นานเกินนี้ถือว่าจบแล้ว
+RECONNECT_TTL = 3 * 60           # Streamlit เก็บ session ที่ websocket หลุดไว้ 2 นาทีให้ reconnect ได้ (+ เผื่อ)
+SWEEP_INTERVAL = 60
+
+_lock = threading.RLock()
+_memory = OrderedDict()   # key -> object (bytes หรือ PIL image) ที่อยู่ใน RAM
+_meta = {}                # key -> (kind, nbytes, mode, size)
+_owners = {}              # key -> {session_id: จำนวน ref}
+_sessions = {}            # session_id -> {"keys": set(), "last_seen": float}
+_memory_bytes = 0
+_disk_bytes = 0
+_last_sweep = 0.0
+_spill_dir = None
+
+
+def _dir():
+    global _spill_dir
+    if _spill_dir is None:
+        _spill_dir = tempfile.mkdtemp(prefix="ringsfinger-artifacts-")
+        atexit.register(shutil.rmtree, _spill_dir, True)
+    return _spill_dir
+
+
+def _path(key):
+    return os.path.join(_dir(), key)
+
+
+def _session(session_id):
+    info = _sessions.setdefault(session_id, {"keys": set(), "last_seen": time.time()})
+    info["last_seen"] = time.time()
+    return info
+
+
+def _spill_until_within_budget():
+    global _memory_bytes, _disk_bytes
+    while _memory_bytes > MEMORY_BUDGET and len(_memory) > 1:
+        key, obj = _memory.popitem(last=False)
+        kind, nbytes, _, _ = _meta[key]
+        path = _path(key)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(obj if kind == "bytes" else obj.tobytes())
+            _disk_bytes += nbytes
+        _memory_bytes -= nbytes
+
+
+def _add(session_id, key, obj, meta):
+    global _memory_bytes
+    with _lock:
+        if key not in _meta:
+            _meta[key] = meta
+            _memory[key] = obj
+            _memory_bytes += meta[1]
+            _spill_until_within_budget()
+        owners = _owners.setdefault(key, {})
+        owners[session_id] = owners.get(session_id, 0) + 1
+        _session(session_id)["keys"].add(key)
+    return key
+
+
+def put_bytes(session_id, data):
+    """Store bytes for session_id and return their reference."""
+    key = "b" + hashlib.sha256(data).hexdigest()
+    return _add(session_id, key, data, ("bytes", len(data), None, None))
+
+
+def put_image(session_id, img, content_hash):
+    """Store a PIL image (content_hash = helpers.image_content_hash) and return its reference."""
+    key = "i" + content_hash
+    nbytes = img.width * img.height * len(img.getbands())
+    return _add(session_id, key, img, ("image", nbytes, img.mode, img.size))
+
+
+def get(key):
+    """The stored bytes / PIL image for a reference, or None if it has been released."""
+    global _memory_bytes
+    with _lock:
+        obj = _memory.get(key)
+        if obj is not None:
+            _memory.move_to_end(key)
+            return obj
+        meta = _meta.get(key)
+        if meta is None:
+            return None
+        kind, nbytes, mode, size = meta
+        with open(_path(key), "rb") as f:
+            data = f.read()
+        if kind == "bytes":
+            obj = data
+        else:
+            obj = Image.frombytes(mode, size, data)
+            obj._content_hash = key[1:]
+        _memory[key] = obj
+        _memory_bytes += nbytes
+        _spill_until_within_budget()
+        return obj
+
+
+def get_many(keys):
+    return [obj for obj in (get(k) for k in keys) if obj is not None]
+
+
+def _drop(key):
+    global _memory_bytes, _disk_bytes
+    kind, nbytes, _, _ = _meta.pop(key)
+    _owners.pop(key, None)
+    if _memory.pop(key, None) is not None:
+        _memory_bytes -= nbytes
+    try:
+        os.remove(_path(key))
+        _disk_bytes -= nbytes
+    except OSError:
+        pass
+
+
+def release(session_id, keys, all_refs=False):
+    """Drop one of session_id's references per key (every one with all_refs).
+
+    Data that no session references any more is deleted from RAM and disk.
+    """
+    with _lock:
+        info = _sessions.get(session_id)
+        for key in keys:
+            owners = _owners.get(key)
+            if owners is None or session_id not in owners:
+                continue
+            owners[session_id] -= 1
+            if all_refs or owners[session_id] <= 0:
+                del owners[session_id]
+                if info: info["keys"].discard(key)
+            if not owners:
+                _drop(key)
+
+
+def release_session(session_id):
+    """Forget everything session_id holds (reset, or the session has ended)."""
+    with _lock:
+        info = _sessions.get(session_id)
+        if info:
+            release(session_id, list(info["keys"]), all_refs=True)
+            _sessions.pop(session_id, None)
+
+
+def touch(session_id, exists=None):
+    """Mark session_id as alive; at most once a minute, garbage-collect ended sessions.
+
+    exists(session_id) -> bool lets the caller ask Streamlit's runtime whether a
+    session is still known (connected, or disconnected but able to reconnect with its
+    session_state). A session is released once exists() has said False for
+    RECONNECT_TTL; without exists only the idle timeout applies.
+    """
+    global _last_sweep
+    with _lock:
+        _session(session_id).pop("gone_since", None)
+        now = time.time()
+        if now - _last_sweep < SWEEP_INTERVAL:
+            return
+        _last_sweep = now
+        ended = []
+        for sid, info in _sessions.items():
+            if exists is not None and not exists(sid):
+                info.setdefault("gone_since", now)
+            else:
+                info.pop("gone_since", None)
+            if now - info["last_seen"] > SESSION_IDLE_TTL or now - info.get("gone_since", now) > RECONNECT_TTL:
+                ended.append(sid)
+    for sid in ended:
+        release_session(sid)
+
+
+def usage():
+    """Current footprint: bytes in RAM / spilled to disk, item and session counts."""
+    with _lock:
+        return {
+            "memory_bytes": _memory_bytes,
+            "memory_budget": MEMORY_BUDGET,
+            "disk_bytes": _disk_bytes,
+            "items": len(_meta),
+            "sessions": len(_sessions),
+        }
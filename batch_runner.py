@@ -0,0 +1,226 @@
+"""Headless batch generation: manifest in, generated + uploaded product photos out.
+
+    python batch_runner.py manifest.csv --workers 4
+
+Manifest (CSV with a header row, or JSONL with one object per line):
+    job_id             optional, defaults to a hash of the row
+    index, middle, ring, little, bracelet, necklace
+                       Shopify product ID(s) for that slot; several IDs can be
+                       separated with "|" or spaces; near-duplicate gallery images
+                       are skipped and each slot keeps at most MAX_REFS_PER_SLOT
+    style_id           ID of a template in the prompt library
+    target_product_id  optional, product the generated photo is uploaded to
+    var_<name>         optional, value for {name} in the style template
+
+Every finished stage is appended to a JSONL journal (default: <manifest>.journal.jsonl).
+Re-running the same command resumes: uploaded jobs are skipped and jobs whose
+image was already generated go straight to SEO + upload, so a crash or Ctrl+C
+never pays for the same image twice.
+
+Keys are read from .streamlit/secrets.toml like the app, or from environment variables.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+
+import streamlit as st
+from PIL import Image
+
+import output_variants
+from helpers import (
+    clean_key, fill_template,
+    get_shopify_product_images, get_target_product_details, upload_image_to_shopify,
+    get_prompts, generate_seo_data, generate_image_multi_finger, select_references,
+)
+
+SLOTS = ["index", "middle", "ring", "little", "bracelet", "necklace"]
+
+
+def read_secret(name):
+    """st.secrets first (same config as the app), then the environment."""
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except Exception:
+        pass
+    return os.environ.get(name, "")
+
+
+def load_manifest(path):
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+    jobs = []
+    for row in rows:
+        row = {k.strip(): (str(v).strip() if v is not None else "") for k, v in row.items() if k}
+        if not row.get("job_id"):
+            row["job_id"] = hashlib.sha1(json.dumps(row, sort_keys=True).encode()).hexdigest()[:12]
+        jobs.append(row)
+    return jobs
+
+
+class Journal:
+    """Append-only JSONL log of finished stages; the latest entry per job wins."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue  # บรรทัดสุดท้ายอาจขาดครึ่งถ้าโปรแกรมตายกลางคัน
+                    self.state[entry["job_id"]] = entry
+
+    def get(self, job_id):
+        return self.state.get(job_id, {})
+
+    def record(self, job_id, stage, **fields):
+        entry = {**self.get(job_id), "job_id": job_id, "stage": stage, "ts": time.time(), **fields}
+        if stage != "failed": entry.pop("error", None)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.state[job_id] = entry
+        return entry
+
+
+def split_ids(value):
+    return [x for x in value.replace("|", " ").replace(",", " ").split() if x]
+
+
+def generate_job(job, cfg, library):
+    """Fetch references for every slot and generate the photo. Returns (image_bytes, error)."""
+    style = library.get(job.get("style_id", ""))
+    if not style:
+        return None, f"Unknown style_id '{job.get('style_id')}'"
+    values = {k[len("var_"):]: v for k, v in job.items() if k.startswith("var_")}
+    prompt = fill_template(style.get("template", ""), values)
+
+    all_images = {}
+    for slot in SLOTS:
+        for product_id in split_ids(job.get(slot, "")):
+            imgs, err = get_shopify_product_images(cfg["shop"], cfg["token"], product_id)
+            if not imgs:
+                return None, f"{slot} {product_id}: {err or 'no images'}"
+            all_images.setdefault(slot, []).extend(imgs)
+        if slot in all_images:
+            all_images[slot], _ = select_references(all_images[slot])
+    if not all_images:
+        return None, "No product IDs in any slot"
+    # hedging ตาม style ได้ แต่ headless ไม่มีใครเลือกจาก gallery -> ใช้รูปแรกที่ได้เสมอ
+    return generate_image_multi_finger(cfg["api_key"], all_images, prompt, candidates=int(style.get("candidates") or 1))
+
+
+def upload_job(job, cfg, image_bytes):
+    """SEO + upload to the target product. Returns (fields for the journal, error)."""
+    target_id = job["target_product_id"]
+    title, handle = get_target_product_details(cfg["shop"], cfg["token"], target_id)
+    if not title:
+        return None, f"Target product {target_id} not found"
+    seo = generate_seo_data(cfg["api_key"], image_bytes, title, handle)
+    filename = seo.get("filename", f"{handle}.jpg")
+    alt = seo.get("alt_text", title)
+    ok, resp = upload_image_to_shopify(cfg["shop"], cfg["token"], target_id, image_bytes, filename, alt, variant=cfg["variant"])
+    if not ok:
+        return None, f"Upload failed: {resp}"
+    return {"filename": filename, "alt_text": alt, "shopify_image_id": resp.get("image", {}).get("id")}, None
+
+
+def run_job(job, cfg, library, journal):
+    job_id = job["job_id"]
+    entry = journal.get(job_id)
+    if entry.get("stage") == "done":
+        return job_id, "skipped"
+
+    image_path = entry.get("image")
+    if image_path and os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+    else:
+        image_bytes, err = generate_job(job, cfg, library)
+        if not image_bytes:
+            journal.record(job_id, "failed", error=f"generate: {err}")
+            return job_id, f"failed: {err}"
+        ext = (Image.open(BytesIO(image_bytes)).format or "png").lower()
+        image_path = os.path.join(cfg["out_dir"], f"{job_id}.{ext}")
+        tmp = image_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(image_bytes)
+        os.replace(tmp, image_path)
+        journal.record(job_id, "generated", image=image_path)
+
+    if job.get("target_product_id") and not cfg["no_upload"]:
+        fields, err = upload_job(job, cfg, image_bytes)
+        if err:
+            journal.record(job_id, "failed", image=image_path, error=f"upload: {err}")
+            return job_id, f"failed: {err}"
+        journal.record(job_id, "done", image=image_path, **fields)
+        return job_id, "uploaded"
+    journal.record(job_id, "done", image=image_path)
+    return job_id, "generated"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate (and upload) jewelry photos for every row of a manifest.")
+    parser.add_argument("manifest", help="CSV or JSONL manifest")
+    parser.add_argument("--workers", type=int, default=2, help="jobs generated in parallel (default 2)")
+    parser.add_argument("--journal", help="journal path (default: <manifest>.journal.jsonl)")
+    parser.add_argument("--out-dir", default="batch_output", help="where generated images are kept (default batch_output)")
+    parser.add_argument("--no-upload", action="store_true", help="generate only, skip SEO + Shopify upload")
+    parser.add_argument("--variant", default=output_variants.ORIGINAL,
+                        help="output_variants encoding to upload, e.g. jpeg, webp-1600 (default original)")
+    args = parser.parse_args(argv)
+    if args.variant != output_variants.ORIGINAL:
+        try:
+            output_variants.parse(args.variant)  # ผิดตอนนี้ดีกว่าจ่ายค่า generate ครบแล้วไปพังตอน upload
+        except ValueError as e:
+            parser.error(str(e))
+
+    cfg = {
+        "api_key": clean_key(read_secret("GEMINI_API_KEY") or read_secret("GOOGLE_API_KEY")),
+        "shop": read_secret("SHOPIFY_SHOP_URL"),
+        "token": read_secret("SHOPIFY_ACCESS_TOKEN"),
+        "out_dir": args.out_dir,
+        "no_upload": args.no_upload,
+        "variant": args.variant,
+    }
+    if not cfg["api_key"] or not cfg["shop"] or not cfg["token"]:
+        print("Missing GEMINI_API_KEY / SHOPIFY_SHOP_URL / SHOPIFY_ACCESS_TOKEN", file=sys.stderr)
+        return 2
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    jobs = load_manifest(args.manifest)
+    journal = Journal(args.journal or f"{args.manifest}.journal.jsonl")
+    library = {str(p.get("id")): p for p in get_prompts()}
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(run_job, job, cfg, library, journal): job["job_id"] for job in jobs}
+        for i, fut in enumerate(as_completed(futures), 1):
+            try:
+                job_id, status = fut.result()
+            except Exception as e:
+                job_id, status = futures[fut], f"failed: {e}"
+                journal.record(job_id, "failed", error=str(e))
+            if status.startswith("failed"): failed += 1
+            print(f"[{i}/{len(jobs)}] {job_id}: {status}", flush=True)
+    print(f"Finished: {len(jobs) - failed} ok, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
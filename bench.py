@@ -0,0 +1,466 @@
+"""Benchmarks for the helpers against local stand-in servers (no API quota is used).
+
+    python bench.py                                        # every scenario at concurrency 1,4,8
+    python bench.py --scenarios fetch,generate --concurrency 1,16 --images 1,10
+    python bench.py --gemini-latency 20 --error-rate 0.05 --json run.json
+    python bench.py --baseline run.json                    # exit 1 if p95 / throughput regressed
+
+The stand-in servers run in this process on 127.0.0.1 and http_client.redirect_host()
+sends the Shopify, CDN, Gemini and JSONBin hostnames to them. The helpers run
+unmodified, with the same pooling, retries, Shopify leaky bucket, caching and
+encoding. Every server waits a configurable latency (gaussian, --jitter) and
+answers --error-rate of the requests with 503. Shopify also enforces its REST
+bucket (--shopify-rate calls/s, 40 burst) and answers 429 when it is full.
+
+Scenarios (one operation each):
+    fetch         get_shopify_product_images with N gallery images, image cache off
+    fetch_cached  the same with a warm image cache
+    fetch_bulk    get_product_images_bulk of 6 products (one per slot) with N images each, image cache off
+    encode        img_to_base64 of N fresh 1024px references
+    generate      generate_image_multi_finger with N references, result cache off
+    edit          edit_generated_image, result cache off
+    seo           generate_seo_data
+    upload        upload_image_to_shopify (staged upload)
+    library       fetch_prompts_remote + put_prompts_remote
+
+Every scenario x concurrency x image count reports the latency distribution,
+throughput and peak RSS. The per-helper span breakdown from tracing follows.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+import http_client
+import image_cache
+import output_variants
+import result_cache
+import thumbnails
+import tracing
+from helpers import (
+    DEFAULT_PROMPTS, MODEL_SEO_GEN,
+    get_shopify_product_images, get_product_images_bulk, upload_image_to_shopify, img_to_base64,
+    generate_seo_data, generate_image_multi_finger, edit_generated_image,
+    fetch_prompts_remote, put_prompts_remote,
+)
+
+SHOP_HOST = "bench-shop.myshopify.com"
+CDN_HOST = "bench-cdn.invalid"
+UPLOAD_HOST = "bench-upload.invalid"
+GEMINI_HOST = "generativelanguage.googleapis.com"
+JSONBIN_HOST = "api.jsonbin.io"
+TOKEN = API_KEY = "bench"
+
+SCENARIOS = ["fetch", "fetch_cached", "fetch_bulk", "encode", "generate", "edit", "seo", "upload", "library"]
+USES_IMAGE_COUNT = {"fetch", "fetch_cached", "fetch_bulk", "encode", "generate"}
+
+
+def photo_like(px, seed=0):
+    """Smooth gradient plus noise: compresses roughly like a product photo, unlike pure noise."""
+    rng = random.Random(seed)
+    base = Image.linear_gradient("L").resize((px, px)).convert("RGB")
+    noise = Image.effect_noise((px, px), 24).convert("RGB")
+    img = Image.blend(base, noise, 0.3)
+    img.putpixel((0, 0), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    return img
+
+
+def jpeg_bytes(img, quality=90):
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+# --- STAND-IN SERVERS ---
+class StandIn:
+    """Settings and mutable state shared by every stand-in server."""
+
+    def __init__(self, args):
+        self.latency = {"shopify": args.shopify_latency, "cdn": args.cdn_latency, "upload": args.shopify_latency,
+                        "gemini": args.gemini_latency, "jsonbin": args.jsonbin_latency}
+        self.jitter = args.jitter
+        self.error_rate = args.error_rate
+        self.shopify_rate = args.shopify_rate
+        self.images = 1                      # จำนวนรูปต่อ product (เปลี่ยนตาม run)
+        self.cdn_image = jpeg_bytes(photo_like(args.image_px))
+        self.result_b64 = img_to_base64(photo_like(args.result_px, seed=1), max_side=args.result_px)
+        self.library = json.loads(json.dumps(DEFAULT_PROMPTS))
+        self.lock = threading.Lock()
+        self.bucket_level, self.bucket_time = 0.0, time.monotonic()
+
+    def wait(self, service):
+        mean = self.latency[service]
+        if mean > 0:
+            time.sleep(max(0.0, random.gauss(mean, mean * self.jitter)))
+
+    def shopify_bucket_full(self):
+        if self.shopify_rate <= 0:
+            return False, "1/40"
+        with self.lock:
+            now = time.monotonic()
+            self.bucket_level = max(0.0, self.bucket_level - (now - self.bucket_time) * self.shopify_rate)
+            self.bucket_time = now
+            if self.bucket_level + 1 > 40:
+                return True, "40/40"
+            self.bucket_level += 1
+            return False, f"{int(self.bucket_level)}/40"
+
+
+def _json(obj, status=200, headers=None):
+    return status, json.dumps(obj).encode(), {"Content-Type": "application/json", **(headers or {})}
+
+
+def route_shopify(state, method, path, body):
+    full, call_limit = state.shopify_bucket_full()
+    headers = {"X-Shopify-Shop-Api-Call-Limit": call_limit}
+    if full:
+        return 429, b'{"errors": "Exceeded 2 calls per second"}', {**headers, "Retry-After": "1.0"}
+    m = re.search(r"/products/(\d+)(/images)?\.json", path)
+    if method == "GET" and m and m.group(2):
+        pid = int(m.group(1))
+        images = [{"id": pid * 1000 + i, "position": i + 1, "updated_at": "2024-01-01T00:00:00Z",
+                   "src": f"https://{CDN_HOST}/{pid}/{i}.jpg"} for i in range(state.images)]
+        return _json({"images": images}, headers=headers)
+    if method == "GET" and m:
+        return _json({"product": {"title": f"Bench Ring {m.group(1)}", "handle": f"bench-ring-{m.group(1)}"}}, headers=headers)
+    if method == "POST" and m and m.group(2):
+        return _json({"image": {"id": random.randrange(10**9), "src": f"https://{CDN_HOST}/uploaded.jpg"}}, 201, headers)
+    if method == "POST" and path.endswith("/graphql.json"):
+        payload = json.loads(body)
+        query = payload.get("query", "")
+        if "nodes(ids:" in query:
+            nodes = []
+            for gid in payload["variables"]["ids"]:
+                pid = int(gid.rsplit("/", 1)[-1])
+                nodes.append({"id": gid, "title": f"Bench Ring {pid}", "handle": f"bench-ring-{pid}", "images": {"nodes": [
+                    {"id": f"gid://shopify/ProductImage/{pid * 1000 + i}", "altText": None, "width": 1024, "height": 1024,
+                     "url": f"https://{CDN_HOST}/{pid}/{i}.jpg?v=1", "working": f"https://{CDN_HOST}/{pid}/{i}_1024x1024.jpg?v=1"}
+                    for i in range(state.images)]}})
+            return _json({"data": {"nodes": nodes}}, headers=headers)
+        if "stagedUploadsCreate" in query:
+            key = uuid.uuid4().hex
+            return _json({"data": {"stagedUploadsCreate": {"userErrors": [], "stagedTargets": [{
+                "url": f"https://{UPLOAD_HOST}/staged/{key}", "resourceUrl": f"https://{UPLOAD_HOST}/files/{key}",
+                "parameters": [{"name": "key", "value": f"tmp/{key}"}]}]}}}, headers=headers)
+        if "productCreateMedia" in query:
+            return _json({"data": {"productCreateMedia": {"mediaUserErrors": [], "media": [
+                {"id": f"gid://shopify/MediaImage/{random.randrange(10**9)}", "alt": "bench", "status": "UPLOADED"}]}}},
+                headers=headers)
+    return 404, b"{}", headers
+
+
+def route_cdn(state, method, path, body):
+    return 200, state.cdn_image, {"Content-Type": "image/jpeg"}
+
+
+def route_upload(state, method, path, body):
+    return 201, b"", {}
+
+
+def route_gemini(state, method, path, body):
+    if MODEL_SEO_GEN.split("/")[-1] in path:
+        text = json.dumps({"filename": "bench-ring.jpg", "alt_text": "Bench ring on hand"})
+        chunks = [{"candidates": [{"content": {"parts": [{"text": text[:20]}]}}]},
+                  {"candidates": [{"content": {"parts": [{"text": text[20:]}]}, "finishReason": "STOP"}]}]
+    else:
+        # เหมือน Gemini จริง: มีข้อความนำก่อน แล้วรูปมาใน part ถัดไป
+        chunks = [{"candidates": [{"content": {"parts": [{"text": "Here is the photo."}]}}]},
+                  {"candidates": [{"content": {"parts": [{"inlineData": {"mimeType": "image/jpeg", "data": state.result_b64}}]}}]},
+                  {"candidates": [{"content": {"parts": []}, "finishReason": "STOP"}]}]
+    if ":streamGenerateContent" in path:
+        data = "".join(f"data: {json.dumps(c)}\r\n\r\n" for c in chunks).encode()
+        return 200, data, {"Content-Type": "text/event-stream"}
+    return _json({"candidates": [{"content": {"parts": [p for c in chunks for p in c["candidates"][0]["content"]["parts"]]}}]})
+
+
+def route_jsonbin(state, method, path, body):
+    if method == "PUT":
+        with state.lock:
+            state.library = json.loads(body)
+        return _json({"record": state.library})
+    with state.lock:
+        return _json({"record": state.library}, headers={"ETag": f'"{hash(json.dumps(state.library))}"'})
+
+
+ROUTES = {"shopify": route_shopify, "cdn": route_cdn, "upload": route_upload,
+          "gemini": route_gemini, "jsonbin": route_jsonbin}
+
+
+def serve(service, state):
+    """Start one stand-in server on a free local port and return its base URL."""
+    route = ROUTES[service]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _handle(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            state.wait(service)
+            if random.random() < state.error_rate:
+                status, data, headers = 503, b"{}", {}
+            else:
+                status, data, headers = route(state, self.command, self.path, body)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = _handle
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_stand_ins(state):
+    for host, service in ((SHOP_HOST, "shopify"), (CDN_HOST, "cdn"), (UPLOAD_HOST, "upload"),
+                          (GEMINI_HOST, "gemini"), (JSONBIN_HOST, "jsonbin")):
+        http_client.redirect_host(host, serve(service, state))
+    os.environ.setdefault("JSONBIN_API_KEY", "bench")
+    os.environ.setdefault("JSONBIN_BIN_ID", "bench")
+
+
+# --- SCENARIOS ---
+# make_op(state, n_images) -> callable ที่เตรียม input ไว้แล้ว, คืน True เมื่อสำเร็จ
+_pid_counter = iter(range(10**6, 10**9))
+
+
+def reference_images(n):
+    return [photo_like(1024, seed=random.randrange(10**9)) for _ in range(n)]
+
+
+def op_fetch(state, n):
+    pid = next(_pid_counter)
+    return lambda: get_shopify_product_images(SHOP_HOST, TOKEN, pid, use_cache=False)[1] is None
+
+
+def op_fetch_cached(state, n):
+    pid = 1000 + random.randrange(4)
+    get_shopify_product_images(SHOP_HOST, TOKEN, pid)  # warm
+    return lambda: get_shopify_product_images(SHOP_HOST, TOKEN, pid)[1] is None
+
+
+def op_fetch_bulk(state, n):
+    pids = [next(_pid_counter) for _ in range(6)]
+    return lambda: all(err is None for _, err in get_product_images_bulk(SHOP_HOST, TOKEN, pids, use_cache=False).values())
+
+
+def op_encode(state, n):
+    imgs = reference_images(n)
+    return lambda: all(img_to_base64(img) for img in imgs)
+
+
+def op_generate(state, n):
+    refs = {"ring": reference_images(n)}
+    return lambda: generate_image_multi_finger(API_KEY, refs, "Bench prompt", use_cache=False)[0] is not None
+
+
+def op_edit(state, n):
+    src = state.cdn_image
+    return lambda: edit_generated_image(API_KEY, src, "Make the ring shine", use_cache=False)[0] is not None
+
+
+def op_seo(state, n):
+    src = state.cdn_image
+    return lambda: generate_seo_data(API_KEY, src, "Bench Ring", "bench-ring").get("filename") == "bench-ring.jpg"
+
+
+def op_upload(state, n):
+    src, pid = state.cdn_image, next(_pid_counter)
+    return lambda: upload_image_to_shopify(SHOP_HOST, TOKEN, pid, src, "bench.jpg", "Bench ring")[0]
+
+
+def op_library(state, n):
+    def run():
+        record, _, err = fetch_prompts_remote()
+        return err is None and put_prompts_remote(record)[0]
+    return run
+
+
+OPS = {name: globals()[f"op_{name}"] for name in SCENARIOS}
+
+
+# --- MEASUREMENT ---
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # macOS: bytes, Linux: KB
+
+
+class PeakRSS:
+    """Highest resident set size seen while the block runs (sampled every 10 ms)."""
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+
+def _timed(op):
+    t0 = time.perf_counter()
+    try:
+        ok = bool(op())
+    except Exception:
+        ok = False
+    return ok, time.perf_counter() - t0
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def run_cell(state, scenario, concurrency, n_images, ops):
+    state.images = n_images
+    prepared = [OPS[scenario](state, n_images) for _ in range(ops)]
+    with PeakRSS() as rss:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(_timed, prepared))
+        wall = time.perf_counter() - t0
+    latencies = sorted(dt for _, dt in results)
+    ok = sum(1 for good, _ in results if good)
+    return {
+        "scenario": scenario, "concurrency": concurrency,
+        "images": n_images if scenario in USES_IMAGE_COUNT else None,
+        "ops": ops, "ok": ok, "errors": ops - ok,
+        "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99), "max": latencies[-1] if latencies else 0.0,
+        "throughput": ops / wall if wall else 0.0, "peak_rss_mb": rss.peak / 2**20,
+    }
+
+
+# --- REPORTING ---
+def print_rows(rows):
+    print(f"{'scenario':<13}{'conc':>5}{'imgs':>5}{'ops':>5}{'err':>5}"
+          f"{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'max s':>9}{'ops/s':>9}{'RSS MB':>9}")
+    for r in rows:
+        print(f"{r['scenario']:<13}{r['concurrency']:>5}{r['images'] if r['images'] is not None else '-':>5}"
+              f"{r['ops']:>5}{r['errors']:>5}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}{r['max']:>9.3f}"
+              f"{r['throughput']:>9.2f}{r['peak_rss_mb']:>9.0f}")
+
+
+def print_spans():
+    print(f"\n{'helper span':<26}{'n':>6}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'out KB/op':>11}{'in KB/op':>10}{'retries':>9}")
+    for r in tracing.summary():
+        print(f"{r['span']:<26}{r['count']:>6}{r['p50']:>9.3f}{r['p95']:>9.3f}{r['p99']:>9.3f}"
+              f"{r['request_bytes'] / r['count'] / 1024:>11.1f}{r['response_bytes'] / r['count'] / 1024:>10.1f}{r['retries']:>9}")
+
+
+def compare(rows, baseline_path, tolerance):
+    """Print p95 / throughput changes against a previous --json run; returns the regressions."""
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {(r["scenario"], r["concurrency"], r["images"]): r for r in json.load(f)["rows"]}
+    regressions = []
+    print(f"\nvs {baseline_path} (tolerance {tolerance:.0%})")
+    for r in rows:
+        b = base.get((r["scenario"], r["concurrency"], r["images"]))
+        if not b:
+            continue
+        p95_change = r["p95"] / b["p95"] - 1 if b["p95"] else 0.0
+        tput_change = r["throughput"] / b["throughput"] - 1 if b["throughput"] else 0.0
+        bad = p95_change > tolerance or tput_change < -tolerance
+        if bad:
+            regressions.append(r)
+        print(f"{'REGRESSED' if bad else 'ok':<10}{r['scenario']:<13} conc={r['concurrency']:<3} imgs={r['images']}"
+              f"  p95 {p95_change:+.0%}  throughput {tput_change:+.0%}")
+    return regressions
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the helpers against local stand-in servers.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 8], help="worker counts (default 1,4,8)")
+    parser.add_argument("--images", type=int_list, default=[1, 5], help="images per product / references (default 1,5)")
+    parser.add_argument("--ops", type=int, default=16, help="operations per scenario/concurrency/images cell (default 16)")
+    parser.add_argument("--shopify-latency", type=float, default=0.08, help="seconds (default 0.08)")
+    parser.add_argument("--cdn-latency", type=float, default=0.03, help="seconds (default 0.03)")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="seconds (default 1.0)")
+    parser.add_argument("--jsonbin-latency", type=float, default=0.15, help="seconds (default 0.15)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency std dev as a fraction of the mean (default 0.2)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503 (default 0)")
+    parser.add_argument("--shopify-rate", type=float, default=http_client.SHOPIFY_LEAK_RATE,
+                        help="Shopify bucket leak rate, calls/s; 0 disables the bucket (default 2)")
+    parser.add_argument("--image-px", type=int, default=2048, help="size of the gallery images served by the CDN (default 2048)")
+    parser.add_argument("--result-px", type=int, default=1024, help="size of the generated image returned by Gemini (default 1024)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", help="compare with a previous --json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 / throughput change vs the baseline (default 0.2)")
+    args = parser.parse_args(argv)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    # cache ทั้งหมดไปอยู่ใน temp dir เพื่อไม่ให้ผลของ bench ปนกับ cache จริงของแอป
+    tmp = tempfile.mkdtemp(prefix="ringsfinger-bench-")
+    image_cache.CACHE_DIR = os.path.join(tmp, "images")
+    result_cache.CACHE_DIR = os.path.join(tmp, "results")
+    output_variants.CACHE_DIR = os.path.join(tmp, "variants")
+    thumbnails.CACHE_DIR = os.path.join(tmp, "thumbs")
+
+    state = StandIn(args)
+    start_stand_ins(state)
+
+    rows = []
+    for scenario in scenarios:
+        counts = args.images if scenario in USES_IMAGE_COUNT else args.images[:1]
+        for n_images in counts:
+            for concurrency in args.concurrency:
+                row = run_cell(state, scenario, concurrency, n_images, args.ops)
+                rows.append(row)
+                print(f"  {scenario} conc={concurrency} imgs={row['images']}: p95 {row['p95']:.3f}s, "
+                      f"{row['throughput']:.2f} ops/s", file=sys.stderr, flush=True)
+
+    print_rows(rows)
+    print_spans()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "rows": rows}, f, indent=2)
+    if args.baseline:
+        return 1 if compare(rows, args.baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
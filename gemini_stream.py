@@ -0,0 +1,232 @@
+"""Gemini calls through streamGenerateContent (server-sent events).
+
+generateContent answers only when the whole response is ready, and the callers
+used to read candidates[0].content.parts[0] of it. With ?alt=sse the same response
+arrives as a series of `data: {json}` events, each a partial GenerateContentResponse
+whose parts continue the answer. They are parsed as they arrive:
+
+- every part of every event is looked at; an inline image is decoded as soon as
+  its event is complete and the call returns at once (the rest is not read)
+- text parts are collected; a response that ends, is blocked or finishes without
+  an image fails on that event, not after the timeout
+- progress (a dict, updated in place) shows the stage, time to first byte and
+  bytes received while the call runs, so the page can show it
+- cancel (a threading.Event, see hedging) is checked between chunks; once set the
+  connection is closed and the call returns CANCELLED
+
+STREAMING (env GEMINI_STREAM, default on) switches the mode; off sends the
+blocking generateContent call and still searches all parts of the response.
+Functions follow the helpers convention and return (result, error).
+"""
+import base64
+import json
+import os
+import threading
+import time
+
+import http_client
+import tracing
+
+STREAMING = os.environ.get("GEMINI_STREAM", "1") != "0"
+READ_CHUNK = 64 * 1024      # bytes ต่อการอ่านหนึ่งครั้ง (event ของรูปยาวหลาย MB)
+CONNECT_TIMEOUT = 10        # วินาที
+TEXT_PREVIEW = 200          # ตัวอักษรของข้อความจาก model ที่เก็บไว้ใน progress
+
+WAITING, RECEIVING = "waiting", "receiving"
+CANCELLED = "Cancelled"
+
+_lock = threading.Lock()
+
+
+def new_progress():
+    """Progress shared by every attempt of one call (hedged candidates add up)."""
+    return {"stage": WAITING, "attempts": 0, "ttfb": None, "bytes": 0, "events": 0, "text": ""}
+
+
+def _update(progress, **add):
+    if progress is None:
+        return
+    with _lock:
+        for field, value in add.items():
+            if field in ("bytes", "events", "attempts"):
+                progress[field] += value
+            elif field == "ttfb":
+                progress[field] = value if progress[field] is None else min(progress[field], value)
+            else:
+                progress[field] = value
+
+
+def stream_url(url):
+    """The streamGenerateContent SSE URL for a generateContent URL."""
+    return url.replace(":generateContent?", ":streamGenerateContent?alt=sse&", 1)
+
+
+def _event_end(buf, start):
+    """(end of the event, start of the next) for the first blank line at or after start, or None."""
+    ends = [(i, i + len(sep)) for sep in (b"\n\n", b"\r\n\r\n") for i in [buf.find(sep, start)] if i >= 0]
+    return min(ends) if ends else None
+
+
+def sse_events(chunks, on_bytes=None):
+    """Yield the JSON payload of each `data:` event in an SSE byte stream (an iterable of bytes)."""
+    buf, scan = bytearray(), 0
+
+    def parse(raw):
+        lines = raw.decode("utf-8").splitlines()
+        data = "\n".join(line[5:].removeprefix(" ") for line in lines if line.startswith("data:"))
+        return json.loads(data) if data else None
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if on_bytes: on_bytes(len(chunk))
+        buf += chunk
+        while True:
+            found = _event_end(buf, scan)
+            if found is None:
+                scan = max(0, len(buf) - 3)  # ตัวคั่นอาจคร่อมสอง chunk
+                break
+            end, nxt = found
+            event = parse(bytes(buf[:end]))
+            del buf[:nxt]
+            scan = 0
+            if event is not None:
+                yield event
+    if buf.strip():
+        event = parse(bytes(buf))
+        if event is not None:
+            yield event
+
+
+def parts_of(response):
+    """All parts of the first candidate of a (partial) GenerateContentResponse."""
+    candidates = response.get("candidates") or [{}]
+    return (candidates[0].get("content") or {}).get("parts") or []
+
+
+def image_from_parts(parts):
+    """Image bytes of the first inline image among parts, else None."""
+    for part in parts:
+        inline = part.get("inline_data") or part.get("inlineData")
+        if inline and inline.get("data"):
+            return base64.b64decode(inline["data"])
+    return None
+
+
+def text_from_parts(parts):
+    return "".join(part.get("text", "") for part in parts)
+
+
+def finish_reason(response):
+    return ((response.get("candidates") or [{}])[0]).get("finishReason")
+
+
+def failure(response):
+    """Why the model stopped without an answer (error / block / finish reason), or None."""
+    if "error" in response:
+        err = response["error"]
+        return f"API Error {err.get('code', '')}: {err.get('message', err)}" if isinstance(err, dict) else f"API Error: {err}"
+    blocked = (response.get("promptFeedback") or {}).get("blockReason")
+    if blocked:
+        return f"Prompt blocked: {blocked}"
+    finish = finish_reason(response)
+    if finish and finish != "STOP":
+        return f"Finished without an image: {finish}"
+    return None
+
+
+def _no_image(text, reason=None):
+    if text: return f"Model returned text: {text}"
+    return reason or "Unknown format"
+
+
+def _post(url, data, stream, timeout):
+    return http_client.post(url, data=data, headers={"Content-Type": "application/json"},
+                            stream=stream, timeout=(CONNECT_TIMEOUT, timeout))
+
+
+def _events(res, started, progress, cancel=None):
+    """sse_events of a streamed response, recording TTFB and bytes as they arrive; stops when cancel is set."""
+    first = True
+
+    def chunks():
+        for chunk in res.iter_content(READ_CHUNK):
+            if cancel is not None and cancel.is_set():
+                return
+            yield chunk
+
+    def on_bytes(n):
+        nonlocal first
+        if first:
+            first = False
+            ttfb = time.perf_counter() - started
+            tracing.annotate(ttfb=round(ttfb, 3))
+            _update(progress, ttfb=ttfb, stage=RECEIVING)
+        _update(progress, bytes=n)
+        tracing.record_response_bytes(n)
+
+    for event in sse_events(chunks(), on_bytes):
+        _update(progress, events=1)
+        yield event
+
+
+def request_image(url, data, progress=None, timeout=60, cancel=None):
+    """One image call with a pre-serialized JSON body. Returns (image bytes, error).
+
+    timeout is the connect-to-first-byte and between-chunks limit, not the total.
+    """
+    _update(progress, attempts=1)
+    started = time.perf_counter()
+    if not STREAMING:
+        res = _post(url, data, False, timeout)
+        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
+        body = res.json()
+        parts = parts_of(body)
+        image = image_from_parts(parts)
+        return (image, None) if image is not None else (None, _no_image(text_from_parts(parts), failure(body)))
+
+    res = _post(stream_url(url), data, True, timeout)
+    try:
+        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
+        text = ""
+        for event in _events(res, started, progress, cancel):
+            parts = parts_of(event)
+            image = image_from_parts(parts)
+            if image is not None:
+                return image, None
+            if parts:
+                text += text_from_parts(parts)
+                if text: _update(progress, text=text[-TEXT_PREVIEW:])
+            if failure(event) or finish_reason(event):
+                return None, _no_image(text, failure(event))  # จบแล้วไม่มีรูป -> ไม่ต้องรอให้ stream ปิดเอง
+        if cancel is not None and cancel.is_set():
+            return None, CANCELLED
+        return None, _no_image(text)
+    finally:
+        res.close()  # ได้รูปแล้ว -> ทิ้งส่วนที่เหลือ ไม่อ่านต่อ
+
+
+def request_text(url, payload, progress=None, timeout=30):
+    """One text call (all text parts joined). Returns (text, error)."""
+    data = json.dumps(payload).encode()
+    _update(progress, attempts=1)
+    started = time.perf_counter()
+    if not STREAMING:
+        res = _post(url, data, False, timeout)
+        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
+        body = res.json()
+        text = text_from_parts(parts_of(body))
+        return (text, None) if text else (None, failure(body) or "Empty response")
+
+    res = _post(stream_url(url), data, True, timeout)
+    try:
+        if res.status_code != 200: return None, f"API Error {res.status_code}: {res.text}"
+        text = ""
+        for event in _events(res, started, progress):
+            text += text_from_parts(parts_of(event))
+            reason = failure(event)
+            if reason:
+                return None, reason
+        return (text, None) if text else (None, "Empty response")
+    finally:
+        res.close()
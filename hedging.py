@@ -0,0 +1,72 @@
+"""Hedged requests: send the same slow call several times and keep what comes back first.
+
+Gemini image latency has a long tail and a call sometimes returns text instead
+of an image. hedged(call, k) starts call() k times on its own threads (spaced by
+delay seconds if given; a failed attempt starts the next one at once) and:
+
+- gallery=False: returns the first valid result; attempts not started yet are
+  cancelled, and the attempts in flight are told to stop
+- gallery=True: waits for all k and returns every valid result
+
+call(cancel) follows the helpers convention and returns (result, error). cancel is
+a threading.Event set once the result is decided; a call should check it while it
+waits (e.g. between response chunks), stop and return (None, error). Attempts run
+with the caller's tracing spans open, so its HTTP numbers include theirs.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import tracing
+
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "0"))   # วินาทีก่อนยิงคำขอถัดไป (0 = ยิงพร้อมกันทั้งหมด)
+MAX_CANDIDATES = 8
+
+
+def hedged(call, k, gallery=False, delay=HEDGE_DELAY):
+    """Returns (result, error), or ([results], error) with gallery; result is None when every attempt failed."""
+    k = max(1, min(int(k), MAX_CANDIDATES))
+    cancel = threading.Event()
+    if k == 1 and not gallery:
+        return call(cancel)
+
+    spans = tracing.current()
+
+    def attempt():
+        with tracing.adopt(spans):
+            return call(cancel)
+
+    pool = ThreadPoolExecutor(max_workers=k, thread_name_prefix="hedge")
+    pending, results, errors = set(), [], []
+    launched, next_launch = 0, 0.0
+    try:
+        while pending or launched < k:
+            now = time.monotonic()
+            if launched < k and now >= next_launch:
+                pending.add(pool.submit(attempt))
+                launched += 1
+                next_launch = now + delay
+                continue
+            timeout = max(0.0, next_launch - now) if launched < k else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    result, error = fut.result()
+                except Exception as e:
+                    result, error = None, str(e)
+                if result is not None:
+                    results.append(result)
+                else:
+                    errors.append(error)
+                    next_launch = 0.0  # ล้มเหลว -> ยิงตัวถัดไปทันที
+            if results and not gallery:
+                break
+    finally:
+        cancel.set()  # attempt ที่ยังวิ่งอยู่ -> ปิด connection แทนที่จะอ่านรูปหลาย MB ทิ้ง
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    error = None if results else "; ".join(dict.fromkeys(e for e in errors if e)) or "No result"
+    if gallery:
+        return (results or None), error  # ล้มเหลวทุกตัว -> None ตาม convention ไม่ใช่ list ว่าง
+    return (results[0] if results else None), error
@@ -0,0 +1,824 @@
+"""Non-UI helpers shared by the Streamlit app (app.py) and the headless batch runner.
+
+Nothing in here renders UI, so the module can be imported outside `streamlit run`.
+"""
+import streamlit as st
+import json
+import base64
+from io import BytesIO
+from PIL import Image, ImageDraw
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import gemini_stream
+import hedging
+import http_client
+import image_cache
+import image_select
+import output_variants
+import payload_budget
+import region_edit
+import result_cache
+import thumbnails
+import tracing
+
+# Model ID
+MODEL_IMAGE_GEN = "models/gemini-3-pro-image-preview" # For generating images
+MODEL_SEO_GEN = "models/gemini-1.5-flash" # For generating SEO text (Fast & Cheap)
+
+# --- HELPER FUNCTIONS (คงเดิม) ---
+def clean_key(value):
+    if value is None: return ""
+    return str(value).strip().replace(" ", "").replace('"', "").replace("'", "").replace("\n", "")
+
+def fill_template(template, values):
+    """แทนค่า {variable} ใน template ของ style ด้วยค่าที่ผู้ใช้กรอก"""
+    for k, v in values.items():
+        template = template.replace(f"{{{k}}}", v)
+    return template
+
+# --- SHOPIFY HELPERS (คงเดิม) ---
+IMAGE_FETCH_WORKERS = 6   # จำนวน thread สูงสุดตอนโหลดรูปจาก Shopify CDN พร้อมกัน
+IMAGE_FETCH_TIMEOUT = 15  # timeout (วินาที) ต่อรูป
+
+@tracing.traced("shopify.image_download")
+def download_product_image(src, timeout=IMAGE_FETCH_TIMEOUT, cache_key=None):
+    """Download + decode one gallery image. Raises on any failure so the caller can report it per image.
+
+    With a cache_key the 1024px working copy comes from image_cache when present;
+    on a miss the downloaded bytes are stored there for every later session.
+    """
+    if cache_key:
+        cached = image_cache.load(cache_key)
+        if cached is not None:
+            tracing.annotate(cache="hit")
+            return cached
+    img_resp = http_client.get(src, timeout=timeout)
+    if img_resp.status_code != 200:
+        raise ValueError(f"HTTP {img_resp.status_code}")
+    if cache_key:
+        return image_cache.store(cache_key, img_resp.content)
+    # decode ใน worker thread เลย และย่อเหลือ 1024px ตั้งแต่ตอน decode
+    return image_cache.open_reduced(img_resp.content)
+
+def download_gallery(galleries, use_cache=True, concurrent=True, max_workers=IMAGE_FETCH_WORKERS, timeout=IMAGE_FETCH_TIMEOUT):
+    """Download several product galleries through one worker pool.
+
+    galleries: {product_id: [{"id", "src", "version"}, ...]} in gallery order, where
+    version changes whenever the image does (REST updated_at, or the versioned CDN URL).
+    Returns {product_id: (images, error)} with the same partial-failure rule as
+    get_shopify_product_images.
+    """
+    tasks = []  # (product_id, ตำแหน่งใน gallery, src, cache key, image id)
+    for product_id, images_data in galleries.items():
+        for i, img_info in enumerate(images_data):
+            image_id = f"shopify:{img_info['id']}:{img_info.get('version')}" if img_info.get("id") else None
+            cache_key = image_cache.make_key(product_id, img_info["id"], img_info.get("version")) if use_cache and image_id else None
+            tasks.append((product_id, i, img_info["src"], cache_key, image_id))
+
+    # results[task] = (PIL image, error message)
+    results = [(None, None)] * len(tasks)
+    if concurrent and len(tasks) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as pool:
+            futures = {pool.submit(download_product_image, src, timeout, cache_key): n for n, (_, _, src, cache_key, _) in enumerate(tasks)}
+            for fut in as_completed(futures):
+                n = futures[fut]
+                try: results[n] = (fut.result(), None)
+                except Exception as e: results[n] = (None, str(e))
+    else:
+        for n, (_, _, src, cache_key, _) in enumerate(tasks):
+            try: results[n] = (download_product_image(src, timeout, cache_key), None)
+            except Exception as e: results[n] = (None, str(e))
+
+    out = {}
+    for product_id, images_data in galleries.items():
+        mine = [(task, result) for task, result in zip(tasks, results) if task[0] == product_id]
+        pil_images, failed = [], []
+        for (_, i, _, _, image_id), (img, err) in mine:
+            if img is not None:
+                if image_id: img._image_id = image_id  # key ของ image_select
+                pil_images.append(img)
+            else:
+                failed.append(f"#{i + 1} ({err})")
+        out[product_id] = (pil_images, f"{len(failed)}/{len(images_data)} images failed: " + ", ".join(failed) if failed else None)
+    return out
+
+# --- PRODUCT METADATA (GraphQL, หลายสินค้าในคำขอเดียว) ---
+PRODUCT_META_TTL = 120        # วินาทีที่เชื่อข้อมูลสินค้าใน cache
+PRODUCTS_PER_QUERY = 10       # ให้ query cost อยู่ใต้ 1000 ของ Shopify
+IMAGES_PER_PRODUCT = 50
+
+PRODUCTS_BY_ID = """
+query productsById($ids: [ID!]!, $size: Int!) {
+  nodes(ids: $ids) {
+    ... on Product {
+      id title handle
+      images(first: %d) { nodes { id altText width height url working: url(transform: {maxWidth: $size, maxHeight: $size}) } }
+    }
+  }
+}
+""" % IMAGES_PER_PRODUCT
+
+_product_meta = {}   # (shop, product_id) -> (เวลาที่โหลด, product หรือ None ถ้าไม่มีสินค้านี้)
+_product_meta_lock = threading.Lock()
+
+def gid_number(gid):
+    return gid.rsplit("/", 1)[-1] if gid else gid
+
+@tracing.traced("shopify.products_bulk")
+def fetch_products_bulk(shop_url, access_token, product_ids):
+    """Title, handle and gallery (URLs with sizes) of many products, PRODUCTS_PER_QUERY per GraphQL call.
+
+    Returns ({product_id: product, or None if there is no such product}, error).
+    Image src is a CDN URL already resized to the image_cache working size.
+    """
+    ids = list(dict.fromkeys(str(p).strip() for p in product_ids if str(p).strip()))
+    found = {pid: None for pid in ids if not pid.isdigit()}
+    ids = [pid for pid in ids if pid.isdigit()]
+    for start in range(0, len(ids), PRODUCTS_PER_QUERY):
+        chunk = ids[start:start + PRODUCTS_PER_QUERY]
+        data, err = shopify_graphql(shop_url, access_token, PRODUCTS_BY_ID, {
+            "ids": [f"gid://shopify/Product/{pid}" for pid in chunk], "size": image_cache.WORKING_SIZE})
+        if err: return found, err
+        for pid, node in zip(chunk, data.get("nodes") or []):
+            found[pid] = None if not node else {
+                "title": node.get("title", ""),
+                "handle": node.get("handle", ""),
+                "images": [{
+                    "id": gid_number(img["id"]), "src": img.get("working") or img["url"], "version": img["url"],
+                    "width": img.get("width"), "height": img.get("height"), "alt": img.get("altText"),
+                } for img in node["images"]["nodes"] if img.get("url")],
+            }
+    return found, None
+
+def get_products(shop_url, access_token, product_ids):
+    """Product metadata from the short-TTL cache; whatever is missing is fetched in one bulk lookup.
+
+    Returns ({product_id: product or None}, error); on error the dict holds what was cached.
+    """
+    shop, now = shop_host(shop_url), time.time()
+    result, missing = {}, []
+    with _product_meta_lock:
+        for pid in dict.fromkeys(str(p).strip() for p in product_ids):
+            hit = _product_meta.get((shop, pid))
+            if hit and now - hit[0] < PRODUCT_META_TTL: result[pid] = hit[1]
+            else: missing.append(pid)
+    if missing:
+        fetched, err = fetch_products_bulk(shop_url, access_token, missing)
+        if err: return result, err
+        with _product_meta_lock:
+            for key in [k for k, (t, _) in _product_meta.items() if now - t >= PRODUCT_META_TTL]:
+                del _product_meta[key]
+            for pid, product in fetched.items():
+                _product_meta[(shop, pid)] = (now, product)
+        result.update(fetched)
+    return result, None
+
+def cached_product(shop_url, product_id):
+    """Product metadata if it is in the cache and fresh, without any request."""
+    hit = _product_meta.get((shop_host(shop_url), str(product_id).strip()))
+    return hit[1] if hit and time.time() - hit[0] < PRODUCT_META_TTL else None
+
+@tracing.traced("shopify.product_images_bulk", errors=False)
+def get_product_images_bulk(shop_url, access_token, product_ids, use_cache=True):
+    """Galleries of many products: one metadata lookup, then every image through one pool.
+
+    Returns {product_id: (images, error)}.
+    """
+    products, err = get_products(shop_url, access_token, product_ids)
+    if err:
+        # GraphQL ไม่ได้ (เช่น token ไม่มีสิทธิ์) -> ทีละสินค้าผ่าน REST
+        return {str(pid).strip(): get_shopify_product_images(shop_url, access_token, pid, use_cache=use_cache) for pid in product_ids}
+    galleries = {pid: product["images"] for pid, product in products.items() if product}
+    out = download_gallery(galleries, use_cache)
+    return {pid: out.get(pid, (None, "Product not found")) for pid in products}
+
+@tracing.traced("shopify.product_images")
+def get_shopify_product_images(shop_url, access_token, product_id, concurrent=True, max_workers=IMAGE_FETCH_WORKERS, timeout=IMAGE_FETCH_TIMEOUT, use_cache=True):
+    """Fetch all gallery images of a product, in gallery order.
+
+    The gallery comes from the product metadata cache (GraphQL bulk lookup), or
+    from REST images.json if GraphQL is not available. With use_cache, images
+    already in image_cache (same image id + version) are not downloaded again.
+
+    Returns (images, error). If only some downloads fail, the images that did load are
+    still returned and error lists the failed ones, e.g. "2/9 images failed: #3 (timeout), ...".
+    """
+    product_id = str(product_id).strip()
+    products, err = get_products(shop_url, access_token, [product_id])
+    if err is None:
+        if not products.get(product_id):
+            return None, "Product not found"
+        images_data = products[product_id]["images"]
+        return download_gallery({product_id: images_data}, use_cache, concurrent, max_workers, timeout)[product_id]
+
+    url = f"https://{shop_host(shop_url)}/admin/api/{SHOPIFY_API_VERSION}/products/{product_id}/images.json"
+    headers = {
+        "X-Shopify-Access-Token": access_token,
+        "Content-Type": "application/json"
+    }
+    
+    try:
+        response = http_client.get(url, headers=headers, timeout=10)
+        if response.status_code == 200:
+            data = response.json()
+            images_data = [
+                {"id": img_info.get("id"), "src": img_info["src"], "version": img_info.get("updated_at")}
+                for img_info in data.get("images", []) if img_info.get("src")
+            ]
+            return download_gallery({product_id: images_data}, use_cache, concurrent, max_workers, timeout)[product_id]
+        else:
+            return None, f"Shopify Error {response.status_code}"
+    except Exception as e:
+        return None, f"Connection Error: {str(e)}"
+
+@tracing.traced("shopify.product_details", errors=False)
+def get_target_product_details(shop_url, access_token, product_id):
+    """(title, handle) of a product from the metadata cache / bulk lookup; REST if GraphQL fails. (None, None) if not found."""
+    products, err = get_products(shop_url, access_token, [product_id])
+    if err is None:
+        product = products.get(str(product_id).strip())
+        return (product["title"], product["handle"]) if product else (None, None)
+    return get_product_details_rest(shop_url, access_token, product_id)
+
+def get_product_details_rest(shop_url, access_token, product_id):
+    """(title, handle) from REST products/<id>.json only; (None, None) if not found or on error."""
+    url = f"https://{shop_host(shop_url)}/admin/api/{SHOPIFY_API_VERSION}/products/{product_id}.json?fields=title,handle"
+    headers = {"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}
+    
+    try:
+        res = http_client.get(url, headers=headers, timeout=10)
+        if res.status_code == 200:
+            p = res.json().get("product", {})
+            title = p.get("title", "")
+            handle = p.get("handle", "")
+            return title, handle
+        else:
+            return None, None
+    except Exception as e:
+        print(f"Error fetching target product: {e}")
+        return None, None
+
+SHOPIFY_API_VERSION = "2024-01"
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_TIMEOUT = (10, 120)  # (connect, read) วินาที
+
+def shop_host(shop_url):
+    shop_url = shop_url.replace("https://", "").replace("http://", "").strip()
+    if not shop_url.endswith(".myshopify.com"): shop_url += ".myshopify.com"
+    return shop_url
+
+def _raw_chunks(data, chunk=UPLOAD_CHUNK):
+    view = memoryview(data)
+    for i in range(0, len(view), chunk):
+        yield bytes(view[i:i + chunk])
+
+def _b64_chunks(data, chunk=UPLOAD_CHUNK):
+    # ตัดทีละก้อนที่ยาวเป็นผลคูณของ 3 -> ไม่มี padding กลาง stream
+    view = memoryview(data)
+    step = chunk - chunk % 3
+    for i in range(0, len(view), step):
+        yield base64.b64encode(view[i:i + step])
+
+class StreamingBody:
+    """Request body sent chunk by chunk with a known Content-Length.
+
+    pieces is a list of (length, make_iter) where make_iter() yields the bytes of
+    that piece; iterating again starts over, so http_client can retry the request.
+    """
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __len__(self):
+        return sum(length for length, _ in self.pieces)
+
+    def __iter__(self):
+        for _, make_iter in self.pieces:
+            yield from make_iter()
+
+def _fixed(data):
+    return (len(data), lambda: [data])
+
+def image_mime_type(image_bytes):
+    try: return Image.MIME.get(Image.open(BytesIO(image_bytes)).format, "image/jpeg")
+    except Exception: return "image/jpeg"
+
+@tracing.traced("shopify.graphql")
+def shopify_graphql(shop_url, access_token, query, variables=None, timeout=20):
+    """POST one Admin GraphQL query. Returns (data, error)."""
+    url = f"https://{shop_host(shop_url)}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"
+    headers = {"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}
+    try:
+        res = http_client.post(url, headers=headers, json={"query": query, "variables": variables or {}}, timeout=timeout)
+        if res.status_code != 200:
+            return None, f"GraphQL Error {res.status_code}: {res.text}"
+        body = res.json()
+    except Exception as e:
+        # connection error / timeout -> คืนเป็น error เพื่อให้ผู้เรียก fallback ไป REST ได้
+        return None, f"Connection Error: {e}"
+    if body.get("errors"):
+        return None, "; ".join(e.get("message", str(e)) for e in body["errors"])
+    return body.get("data", {}), None
+
+STAGED_UPLOADS_CREATE = """
+mutation stagedUploadsCreate($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+PRODUCT_CREATE_MEDIA = """
+mutation productCreateMedia($productId: ID!, $media: [CreateMediaInput!]!) {
+  productCreateMedia(productId: $productId, media: $media) {
+    media { id alt status }
+    mediaUserErrors { field message }
+  }
+}
+"""
+
+@tracing.traced("shopify.staged_upload")
+def staged_upload_image(shop_url, access_token, product_id, image_bytes, filename, alt_text):
+    """Shopify staged upload: reserve a target, stream the raw bytes as multipart, attach to the product.
+
+    The image is never base64-encoded or copied into a JSON string.
+    Returns (True, {"image": {...}}) like the REST upload, or (False, error).
+    """
+    mime_type = image_mime_type(image_bytes)
+    data, err = shopify_graphql(shop_url, access_token, STAGED_UPLOADS_CREATE, {"input": [{
+        "resource": "IMAGE", "filename": filename, "mimeType": mime_type,
+        "httpMethod": "POST", "fileSize": str(len(image_bytes)),
+    }]})
+    if err: return False, err
+    result = data["stagedUploadsCreate"]
+    if result["userErrors"] or not result["stagedTargets"]:
+        return False, f"stagedUploadsCreate: {result['userErrors']}"
+    target = result["stagedTargets"][0]
+
+    # multipart/form-data: parameters ที่ Shopify ให้มาก่อน แล้วตามด้วย field "file" เป็นตัวสุดท้าย
+    boundary = f"----ringsfinger{hashlib.md5(image_bytes[:4096]).hexdigest()}"
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{p["name"]}"\r\n\r\n{p["value"]}\r\n'.encode()
+        for p in target["parameters"]
+    )
+    safe_name = filename.replace('"', "")
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+             f"Content-Type: {mime_type}\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    body = StreamingBody([_fixed(head), (len(image_bytes), lambda: _raw_chunks(image_bytes)), _fixed(tail)])
+    res = http_client.post(target["url"], data=body, timeout=UPLOAD_TIMEOUT,
+                           headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    if not 200 <= res.status_code < 300:
+        return False, f"Staged upload Error {res.status_code}: {res.text[:300]}"
+
+    data, err = shopify_graphql(shop_url, access_token, PRODUCT_CREATE_MEDIA, {
+        "productId": f"gid://shopify/Product/{product_id}",
+        "media": [{"originalSource": target["resourceUrl"], "alt": alt_text, "mediaContentType": "IMAGE"}],
+    })
+    if err: return False, err
+    result = data["productCreateMedia"]
+    if result["mediaUserErrors"] or not result["media"]:
+        return False, f"productCreateMedia: {result['mediaUserErrors']}"
+    media = result["media"][0]
+    return True, {"image": {"id": media["id"], "alt": media.get("alt"), "src": target["resourceUrl"], "status": media.get("status")}}
+
+@tracing.traced("shopify.upload")
+def upload_image_to_shopify(shop_url, access_token, product_id, image_bytes, filename, alt_text, staged=True,
+                           variant=output_variants.ORIGINAL):
+    """Attach image_bytes to the product. Returns (success, response json or error).
+
+    variant picks which output_variants encoding is sent ("original" = the bytes as they are);
+    the extension of filename is changed to match it.
+
+    staged=True uses the streaming staged-upload flow and falls back to the REST
+    images.json endpoint if it fails (e.g. the token has no write_files scope).
+    The REST body is also streamed: base64 is produced chunk by chunk while sending.
+    """
+    if variant != output_variants.ORIGINAL:
+        image_bytes = output_variants.get(image_bytes, variant)
+        filename = f"{os.path.splitext(filename)[0]}.{output_variants.extension(variant)}"
+        tracing.annotate(variant=variant)
+    
+    staged_error = None
+    if staged:
+        try:
+            ok, resp = staged_upload_image(shop_url, access_token, product_id, image_bytes, filename, alt_text)
+            if ok: return ok, resp
+            staged_error = resp
+        except Exception as e:
+            staged_error = str(e)
+
+    url = f"https://{shop_host(shop_url)}/admin/api/{SHOPIFY_API_VERSION}/products/{product_id}/images.json"
+    headers = {"X-Shopify-Access-Token": access_token, "Content-Type": "application/json"}
+    
+    # {"image": {"filename": ..., "alt": ..., "attachment": "<base64>"}} โดยไม่สร้าง base64 string ทั้งก้อน
+    meta = json.dumps({"filename": filename, "alt": alt_text})
+    head = ('{"image": ' + meta[:-1] + ', "attachment": "').encode()
+    tail = b'"}}'
+    b64_len = 4 * ((len(image_bytes) + 2) // 3)
+    body = StreamingBody([_fixed(head), (b64_len, lambda: _b64_chunks(image_bytes)), _fixed(tail)])
+    
+    try:
+        response = http_client.post(url, headers=headers, data=body, timeout=UPLOAD_TIMEOUT)
+        if response.status_code in [200, 201]:
+            return True, response.json()
+        else:
+            err = f"Error {response.status_code}: {response.text}"
+            return False, f"{err} (staged upload: {staged_error})" if staged_error else err
+    except Exception as e:
+        return False, str(e)
+
+# --- LIBRARY FUNCTIONS (คงเดิม) ---
+DEFAULT_PROMPTS = [
+    {
+        "id": "p1", "name": "Luxury Hand (Ring)", "category": "Ring",
+        "template": "High-end jewelry photography, soft studio lighting, realistic skin texture, neutral background.",
+        "variables": "",
+        "sample_url": "https://upload.wikimedia.org/wikipedia/commons/thumb/c/c2/Ring_render.jpg/320px-Ring_render.jpg"
+    }
+]
+
+JSONBIN_NOT_CONFIGURED = "not configured"
+
+def jsonbin_credentials():
+    """(API_KEY, BIN_ID) จาก secrets หรือ environment, ค่าว่างถ้ายังไม่ได้ตั้ง"""
+    def secret(name):
+        try: value = st.secrets.get(name, "")
+        except Exception: value = ""
+        return clean_key(value or os.environ.get(name, ""))
+    return secret("JSONBIN_API_KEY"), secret("JSONBIN_BIN_ID")
+
+@tracing.traced("jsonbin.fetch")
+def fetch_prompts_remote(etag=None):
+    """Read the library bin. Returns (record, etag, error).
+
+    record is None when JSONBin answers 304 to our If-None-Match (unchanged),
+    or on error; error is JSONBIN_NOT_CONFIGURED when there are no JSONBin secrets.
+    """
+    API_KEY, BIN_ID = jsonbin_credentials()
+    if not API_KEY or not BIN_ID: return None, None, JSONBIN_NOT_CONFIGURED
+    
+    url = f"https://api.jsonbin.io/v3/b/{BIN_ID}/latest"
+    headers = {"X-Master-Key": API_KEY}
+    if etag: headers["If-None-Match"] = etag
+    try:
+        response = http_client.get(url, headers=headers, timeout=5)
+        if response.status_code == 304:
+            return None, etag, None
+        if response.status_code == 200:
+            return response.json().get("record", DEFAULT_PROMPTS), response.headers.get("ETag"), None
+        return None, None, f"JSONBin Error {response.status_code}"
+    except Exception as e:
+        return None, None, str(e)
+
+@tracing.traced("jsonbin.put")
+def put_prompts_remote(data):
+    """Overwrite the library bin. Returns (success, error)."""
+    API_KEY, BIN_ID = jsonbin_credentials()
+    if not API_KEY or not BIN_ID: return False, JSONBIN_NOT_CONFIGURED
+    
+    url = f"https://api.jsonbin.io/v3/b/{BIN_ID}"
+    headers = {"Content-Type": "application/json", "X-Master-Key": API_KEY}
+    try:
+        response = http_client.put(url, json=data, headers=headers, timeout=10)
+        if response.status_code == 200: return True, None
+        return False, f"JSONBin Error {response.status_code}: {response.text[:200]}"
+    except Exception as e:
+        return False, str(e)
+
+def get_prompts():
+    record, _, _ = fetch_prompts_remote()
+    return record if record is not None else DEFAULT_PROMPTS
+
+# --- IMAGE HELPER (PIL to Base64) ---
+PREVIEW_SIZE = 256
+
+def decode_reference(src):
+    """Decode an uploaded file / raw bytes once into the 1024px RGB working copy used everywhere."""
+    return image_cache.open_reduced(src)
+
+def preview_of(img, size=PREVIEW_SIZE):
+    """JPEG preview bytes for the UI thumbnail grid, from the shared thumbnails cache."""
+    return thumbnails.for_image(img, image_content_hash(img), size)
+
+def image_size(image_bytes):
+    """(width, height) from the image header, without decoding the pixels."""
+    return Image.open(BytesIO(image_bytes)).size
+
+def region_preview(image_bytes, region, size=PREVIEW_SIZE):
+    """Preview of image_bytes with the edit region (solid) and the context sent with it (thin) outlined."""
+    src = Image.open(BytesIO(image_bytes))
+    roi = region_edit.Region(src, region)
+    preview = Image.open(BytesIO(thumbnails.for_bytes(image_bytes, size))).convert("RGB")
+    scale = preview.width / src.width
+    draw = ImageDraw.Draw(preview)
+    draw.rectangle([v * scale for v in roi.crop_box], outline=(255, 200, 0), width=1)
+    draw.rectangle([v * scale for v in roi.box], outline=(255, 60, 60), width=3)
+    buf = BytesIO()
+    preview.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def image_content_hash(img):
+    """Hash of the decoded pixels; memoized on the image object, which is never modified in place."""
+    content_hash = getattr(img, "_content_hash", None)
+    if content_hash is None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{img.mode}:{img.size}".encode())
+        h.update(img.tobytes())
+        content_hash = h.hexdigest()
+        img._content_hash = content_hash
+    return content_hash
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _encode_jpeg_base64(content_hash, max_side, quality, _img):
+    # _img ขึ้นต้นด้วย _ -> streamlit ไม่เอาไป hash, ใช้ content_hash เป็น key แทน
+    return base64.b64encode(image_cache.make_working_copy(_img, max_side, quality)).decode()
+
+@tracing.traced("encode.img_to_base64")
+def img_to_base64(img, max_side=1024, quality=90):
+    """JPEG (max_side px, quality) as base64. Cached per image content, and works on a copy so img is untouched."""
+    return _encode_jpeg_base64(image_content_hash(img), max_side, quality, img)
+
+# --- NEW HELPER: Bytes to Base64 String ---
+def bytes_to_base64_str(image_bytes):
+    """Helper to convert raw bytes directly to base64 string"""
+    return base64.b64encode(image_bytes).decode('utf-8')
+
+# --- AI FUNCTION: SEO (คงเดิม) ---
+@tracing.traced("gemini.seo")
+def generate_seo_data(api_key, image_bytes, product_title, product_handle):
+    # ... (code เดิม) ...
+    key = clean_key(api_key)
+    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_SEO_GEN}:generateContent?key={key}"
+    
+    prompt = f"""
+    You are an SEO expert for a Jewelry E-commerce store.
+    
+    CONTEXT:
+    This image is being uploaded to a product page.
+    Target Product Name: "{product_title}"
+    Target URL Slug (Handle): "{product_handle}"
+    
+    TASK:
+    Create an SEO-friendly image filename and an Alt Text attribute specifically for this product.
+    
+    REQUIREMENTS:
+    1. filename: MUST contain the product name or handle. Use lowercase, hyphens (-) as separators. End with .jpg.
+       Example: if product is "Gold Ring", filename -> "gold-ring-model-hand.jpg"
+    2. alt_text: Describe the image naturally but MUST include the product name "{product_title}". Max 125 characters.
+    
+    OUTPUT FORMAT (JSON ONLY):
+    {{
+        "filename": "...",
+        "alt_text": "..."
+    }}
+    """
+    
+    b64_img = base64.b64encode(image_bytes).decode('utf-8')
+    
+    payload = {
+        "contents": [{
+            "parts": [
+                {"text": prompt},
+                {"inline_data": {"mime_type": image_mime_type(image_bytes), "data": b64_img}}
+            ]
+        }],
+        "generationConfig": {"response_mime_type": "application/json"}
+    }
+    
+    try:
+        # JSON อาจถูกแบ่งมาหลาย part/หลาย chunk -> gemini_stream ต่อข้อความให้ครบก่อน
+        result, error = gemini_stream.request_text(url, payload, timeout=30)
+        if result:
+            return json.loads(result)
+        else:
+            fallback_name = f"{product_handle}-model.jpg" if product_handle else "ring-generated.jpg"
+            return {"filename": fallback_name, "alt_text": product_title or "Ring on hand"}
+    except Exception as e:
+        return {"filename": "ring-generated.jpg", "alt_text": "Ring on hand"}
+
+# --- GEMINI IMAGE RESPONSE ---
+@tracing.traced("gemini.attempt")
+def post_image_request(url, data, progress=None, cancel=None):
+    """One Gemini image call (streamed, see gemini_stream) with a pre-serialized JSON body. Returns (image bytes, error)."""
+    try:
+        return gemini_stream.request_image(url, data, progress, timeout=60, cancel=cancel)
+    except Exception as e: return None, str(e)
+
+def request_image(url, body, use_cache, cache_key, candidates=1, gallery=False, progress=None):
+    """Send body to url, hedged over `candidates` parallel calls (see hedging). The first image goes to result_cache.
+
+    progress (gemini_stream.new_progress()) is updated in place by every attempt while they run.
+    """
+    data = json.dumps(body).encode()  # serialize ครั้งเดียว ใช้ซ้ำทุก candidate
+    tracing.annotate(candidates=candidates, gallery=gallery, streaming=gemini_stream.STREAMING)
+    result, error = hedging.hedged(lambda cancel: post_image_request(url, data, progress, cancel), candidates, gallery)
+    first = result[0] if gallery and result else result
+    if first and use_cache: result_cache.put(cache_key, first)
+    return result, error
+
+def cached_result(cache_key, use_cache, force_regenerate):
+    """ผลลัพธ์เดิมจาก result_cache ถ้ามี (force_regenerate = ข้าม cache แต่ยังเก็บผลใหม่ลงไป)"""
+    if not use_cache or force_regenerate: return None
+    cached = result_cache.get(cache_key)
+    if cached: tracing.annotate(cache="hit")
+    return cached
+
+# --- REFERENCE SELECTION ---
+def select_references(imgs, max_images=image_select.MAX_PER_SLOT, skip_duplicates=True):
+    """Drop near-duplicates and keep at most max_images per slot. Returns (kept images, {index: reason})."""
+    image_ids = [getattr(img, "_image_id", None) or image_content_hash(img) for img in imgs]
+    kept, dropped = image_select.select(imgs, image_ids, max_images,
+                                        image_select.DUPLICATE_DISTANCE if skip_duplicates else -1)
+    return [imgs[i] for i in kept], dropped
+
+# --- REFERENCE PAYLOAD ---
+REFERENCE_ORDER = ["index", "middle", "ring", "little", "bracelet", "necklace"]
+
+def reference_list(all_images_dict):
+    """[(slot, image, is_primary)] in the order they are sent; the first image of a slot is its primary."""
+    return [(slot, img, i == 0) for slot in REFERENCE_ORDER for i, img in enumerate(all_images_dict.get(slot) or [])]
+
+def plan_reference_payload(all_images_dict):
+    """Resolution/quality per reference so the request fits payload_budget (see Plan.summary())."""
+    return payload_budget.plan(reference_list(all_images_dict), img_to_base64)
+
+# --- AI FUNCTION: GENERATE FROM SCRATCH (คงเดิมจาก Logiv V2) ---
+@tracing.traced("gemini.generate")
+def generate_image_multi_finger(api_key, all_images_dict, base_prompt, use_cache=True, force_regenerate=False,
+                                candidates=1, gallery=False, progress=None):
+    """Generate the jewelry photo. Returns (image bytes, error), or ([image bytes], error) with gallery.
+
+    Identical requests (same reference pixels in the same order, prompt, model and
+    generationConfig) are answered from result_cache unless force_regenerate is set.
+    candidates > 1 sends that many requests in parallel and keeps the first image,
+    or every image with gallery (which always makes new calls).
+    progress is a gemini_stream.new_progress() dict to follow the call while it runs.
+    """
+    key = clean_key(api_key)
+    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_IMAGE_GEN}:generateContent?key={key}"
+    
+    jewelry_locations = {
+        "index": "Index Finger (finger next to thumb)",
+        "middle": "Middle Finger (longest center finger)", 
+        "ring": "Ring Finger (finger between middle and little)",
+        "little": "Little Finger (pinky, smallest finger)",
+        "bracelet": "Wrist",
+        "necklace": "Neck"
+    }
+    
+    empty_fingers = []
+    finger_keys = ["index", "middle", "ring", "little"]
+    for f_key in finger_keys:
+        if f_key not in all_images_dict or not all_images_dict[f_key]:
+            empty_fingers.append(jewelry_locations[f_key])
+            
+    ordered_keys = REFERENCE_ORDER
+    parts = [] 
+    
+    has_necklace = "necklace" in all_images_dict and all_images_dict["necklace"]
+    framing = "Portrait/Bust shot showing Hand and Neck" if has_necklace else "Close-up Macro shot of Hand and Wrist only"
+    
+    prompt_intro = f"""
+    {base_prompt}
+    
+    IMAGE SETTING:
+    - TYPE: Professional Jewelry Photography
+    - FRAMING: {framing}
+    - SUBJECT: A single female model.
+    """
+    
+    positive_instructions = []
+    image_global_index = 1
+    
+    for item_key in ordered_keys:
+        if item_key in all_images_dict and all_images_dict[item_key]:
+            imgs = all_images_dict[item_key]
+            count = len(imgs)
+            loc_name = jewelry_locations[item_key]
+            
+            if count == 1:
+                ref_text = f"reference image #{image_global_index}"
+                image_global_index += 1
+            else:
+                ref_text = f"reference images #{image_global_index} to #{image_global_index + count - 1}"
+                image_global_index += count
+            
+            instruction = f"   * {loc_name.upper()}: WEARING the jewelry design shown in {ref_text}."
+            positive_instructions.append(instruction)
+
+    # ย่อ/ลด quality รูปอ้างอิงให้ payload รวมไม่เกิน budget (รูปแรกของแต่ละ slot ได้ความละเอียดก่อน)
+    payload = plan_reference_payload(all_images_dict)
+    tracing.annotate(payload_bytes=payload.total_bytes, payload_tokens=payload.tokens, references=len(payload.refs),
+                     references_reduced=payload.downscaled)
+    for data in payload.parts:
+        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": data}})
+    ref_hashes = [image_content_hash(r.img) for r in payload.refs]
+
+    negative_instructions = []
+    if empty_fingers:
+        empty_list_str = ", ".join(empty_fingers)
+        negative_instructions.append(f"   * The following fingers MUST BE BARE (No Rings): {empty_list_str}.")
+    
+    negative_instructions.append("   * Do NOT put rings on the Thumb.")
+    negative_instructions.append("   * Do NOT duplicate items.")
+    
+    full_prompt_text = f"""
+    {prompt_intro}
+
+    --- MANDATORY PLACEMENT INSTRUCTIONS ---
+    Please strictly follow these assignments. Do not shift jewelry to other positions.
+
+    ACTIVE ZONES (WEAR JEWELRY HERE):
+    {chr(10).join(positive_instructions)}
+
+    EMPTY ZONES (NO JEWELRY HERE):
+    {chr(10).join(negative_instructions)}
+
+    --- QUALITY GUIDELINES ---
+    1. Realistic skin texture and lighting.
+    2. Jewelry details (gemstones, metal) must match references exactly.
+    3. Anatomically correct hand pose.
+    """
+
+    parts.insert(0, {"text": full_prompt_text})
+    generation_config = {"temperature": 0.15}
+    
+    cache_key = result_cache.fingerprint("generate", MODEL_IMAGE_GEN, ref_hashes, payload.levels, full_prompt_text, generation_config)
+    cached = None if gallery else cached_result(cache_key, use_cache, force_regenerate)
+    if cached: return cached, None
+    
+    body = {"contents": [{"parts": parts}], "generationConfig": generation_config}
+    return request_image(url, body, use_cache, cache_key, candidates, gallery, progress)
+
+# --- NEW AI FUNCTION: EDIT EXISTING IMAGE ---
+@tracing.traced("gemini.edit")
+def edit_generated_image(api_key, current_image_bytes, edit_instructions, use_cache=True, force_regenerate=False,
+                         candidates=1, gallery=False, region=None, progress=None):
+    """ฟังก์ชันสำหรับแก้ไขภาพเดิมตามคำสั่งใหม่ (ใช้ result_cache และ candidates/gallery เหมือน generate_image_multi_finger)
+
+    region=(left, top, right, bottom) in pixels: only that part (plus some context) is sent,
+    and the edited patch is blended back so the rest of the image stays pixel-identical (see region_edit).
+    """
+    key = clean_key(api_key)
+    url = f"https://generativelanguage.googleapis.com/v1beta/{MODEL_IMAGE_GEN}:generateContent?key={key}"
+    
+    roi = None
+    if region:
+        try:
+            src = Image.open(BytesIO(current_image_bytes))
+            src.load()
+            roi = region_edit.Region(src, region)
+        except Exception as e:
+            return None, f"Region error: {e}"
+        send_bytes = roi.patch()
+        tracing.annotate(region=list(roi.crop_box), payload_bytes=len(send_bytes))
+    else:
+        send_bytes = current_image_bytes
+    
+    # แปลง bytes ภาพปัจจุบันเป็น base64 string
+    base64_img = bytes_to_base64_str(send_bytes)
+
+    # สร้าง Prompt สำหรับการแก้ไข
+    edit_prompt = f"""
+    Based on the provided image, perform the following modification:
+    {edit_instructions}
+
+    IMPORTANT:
+    - Maintain professional jewelry photography style, lighting, and high realism as seen in the original image.
+    - Keep all other elements of the original image intact unless specified otherwise by the instructions.
+    - Ensure anatomically correct hand structure if moving rings.
+    """
+    if roi:
+        edit_prompt += """- The image is a close-up crop of a larger photo and will be pasted back into it:
+      keep the framing, scale, aspect ratio and everything near the edges exactly as they are.
+    """
+
+    # สร้าง Payload (รูปเดิม + คำสั่งแก้ไข)
+    parts = [
+        {"text": edit_prompt},
+        {"inline_data": {"mime_type": image_mime_type(send_bytes), "data": base64_img}}
+    ]
+    # ใช้ temperature ต่ำๆ เพื่อให้คงสภาพเดิมไว้ให้มากที่สุด
+    generation_config = {"temperature": 0.1}
+    
+    # โหมด region: cache เก็บ patch ที่ได้จาก Gemini, การ composite ทำใหม่ทุกครั้ง (เร็ว)
+    source_hash = hashlib.sha256(current_image_bytes).hexdigest()
+    cache_key = result_cache.fingerprint("edit", MODEL_IMAGE_GEN, source_hash, roi and roi.crop_box, edit_prompt, generation_config)
+    cached = None if gallery else cached_result(cache_key, use_cache, force_regenerate)
+    if not cached:
+        body = {"contents": [{"parts": parts}], "generationConfig": generation_config}
+        cached, error = request_image(url, body, use_cache, cache_key, candidates, gallery, progress)
+        if not cached or not roi: return cached, error
+    elif not roi:
+        return cached, None
+    
+    try:
+        if isinstance(cached, list): return [roi.composite(patch) for patch in cached], None
+        return roi.composite(cached), None
+    except Exception as e:
+        return None, f"Could not blend the edited region: {e}"
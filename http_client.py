@@ -0,0 +1,189 @@
+"""Process-wide HTTP client shared by every network helper (Shopify, Gemini, JSONBin).
+
+Streamlit re-executes app.py on every rerun, but imported modules live for the
+whole process, so the connection pools kept here are reused by every session.
+
+- one requests.Session (own connection pool, keep-alive) per host
+- retry with jittered exponential backoff on 429/5xx and connection errors
+- Shopify Admin REST calls wait for room in the shop's leaky bucket
+  (X-Shopify-Shop-Api-Call-Limit) before being sent; GraphQL has its own
+  cost-based limit on the server and does not use this bucket
+- status, body sizes and retries of every call are reported to tracing
+
+requests is imported on the first call, not at import time, so pages that make no
+request (the first paint of a new process) do not pay for loading it.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import tracing
+
+POOL_SIZE = 10          # connection ต่อ host (ต้อง >= จำนวน thread ที่ยิง host เดียวกันพร้อมกัน)
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5      # วินาที
+BACKOFF_MAX = 10.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+SHOPIFY_LEAK_RATE = 2.0       # calls/sec ที่ bucket ของ Shopify (REST, standard plan) ระบายออก
+SHOPIFY_BUCKET_MARGIN = 2     # เผื่อที่ว่างไว้สำหรับ request ที่กำลังวิ่งอยู่
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_redirects = {}   # host -> base URL ที่ใช้แทน (stand-in server ของ bench.py)
+
+
+def get_session(host):
+    """Return the pooled keep-alive session for host, creating it on first use."""
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+
+class ShopifyBucket:
+    """Client-side mirror of one shop's REST leaky bucket."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used = 0.0
+        self.capacity = 40.0
+        self.updated = time.monotonic()
+
+    def _level(self, now):
+        return max(0.0, self.used - (now - self.updated) * SHOPIFY_LEAK_RATE)
+
+    def acquire(self):
+        """Block until one more call fits in the bucket, then reserve it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                level = self._level(now)
+                if level + 1 <= self.capacity - SHOPIFY_BUCKET_MARGIN:
+                    self.used, self.updated = level + 1, now
+                    return
+                wait = (level + 1 - (self.capacity - SHOPIFY_BUCKET_MARGIN)) / SHOPIFY_LEAK_RATE
+            time.sleep(wait)
+
+    def update(self, header):
+        """Sync with the server's view, header looks like "32/40"."""
+        try:
+            used, capacity = (float(x) for x in header.split("/"))
+        except (ValueError, AttributeError):
+            return
+        with self.lock:
+            self.used, self.capacity, self.updated = used, capacity, time.monotonic()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def shopify_bucket(host):
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = ShopifyBucket()
+        return _buckets[host]
+
+
+def is_shopify_rest(host, path):
+    """Admin REST call (counted in the REST bucket); graphql.json is not, its responses never carry the header."""
+    return host.endswith(".myshopify.com") and "/admin/" in path and not path.endswith("/graphql.json")
+
+
+def backoff_delay(attempt, response=None):
+    """Full-jitter exponential backoff; a Retry-After header from the server wins."""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try: return min(float(retry_after), BACKOFF_MAX)
+            except ValueError: pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def redirect_host(host, base_url):
+    """Send every request for host to base_url instead, e.g. a local stand-in server.
+
+    Pooling and Shopify rate limiting still follow the original host.
+    """
+    _redirects[host] = base_url.rstrip("/")
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    try:
+        return len(body)  # bytes / str / StreamingBody
+    except TypeError:
+        return 0  # generator ที่ไม่รู้ขนาด
+
+
+def _response_size(response, streamed):
+    if streamed:
+        return 0  # ผู้อ่าน stream รายงานเองตอนอ่าน (tracing.record_response_bytes), chunked ไม่มี Content-Length
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        return int(length)
+    return len(response.content)
+
+
+def request(method, url, retries=MAX_RETRIES, **kwargs):
+    """Send a request through the host's pooled session.
+
+    Retries on 429/5xx and on connection errors (the request never reached the
+    server). Read timeouts are not retried because the call may already have been
+    processed (and billed, for Gemini). After the last attempt the final response is
+    returned as-is so callers keep doing their own status_code checks; the number of
+    retries used is available as response.retries.
+    """
+    import requests
+
+    parts = urlsplit(url)
+    host = parts.netloc
+    session = get_session(host)
+    bucket = shopify_bucket(host) if is_shopify_rest(host, parts.path) else None
+    if host in _redirects:
+        url = _redirects[host] + url[len(f"{parts.scheme}://{host}"):]
+
+    attempt = 0
+    while True:
+        if bucket: bucket.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            if attempt >= retries: raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        if bucket: bucket.update(response.headers.get("X-Shopify-Shop-Api-Call-Limit"))
+        if response.status_code in RETRY_STATUS and attempt < retries:
+            delay = backoff_delay(attempt, response)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            continue
+        response.retries = attempt
+        tracing.record_http(response.status_code, _body_size(response.request.body),
+                            _response_size(response, kwargs.get("stream", False)), attempt)
+        return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
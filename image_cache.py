@@ -0,0 +1,166 @@
+"""Persistent on-disk cache for Shopify product images, shared by every session.
+
+Layout under CACHE_DIR:
+    keys/<sha256 of product_id:image_id:updated_at>   -> content hash of the downloaded bytes
+    blobs/<content hash>.1024.jpg                      -> pre-resized working copy (max side 1024px)
+
+Only the working copy is stored. Galleries from the GraphQL lookup are already
+downloaded through the CDN's WORKING_SIZE transform URL, and nothing reads the
+downloaded bytes back. .orig blobs written by older versions are deleted on first use.
+
+Blobs are content-addressed, so the same picture attached to several products is
+stored once. An edited image gets a new updated_at and therefore a new key.
+File mtimes double as the LRU clock: every hit touches the blob and the oldest
+blobs are evicted once the cache grows past its byte budget.
+"""
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "images"))
+CACHE_BUDGET_BYTES = int(os.environ.get("IMAGE_CACHE_BUDGET_MB", "512")) * 1024 * 1024
+WORKING_SIZE = 1024
+WORKING_QUALITY = 95
+
+_lock = threading.Lock()
+_total_bytes = None  # ขนาดรวมของ blobs/ (คำนวณครั้งแรกตอนใช้งาน)
+
+
+def _keys_dir():
+    return os.path.join(CACHE_DIR, "keys")
+
+
+def _blobs_dir():
+    return os.path.join(CACHE_DIR, "blobs")
+
+
+def make_key(product_id, image_id, updated_at):
+    return hashlib.sha256(f"{product_id}:{image_id}:{updated_at}".encode()).hexdigest()
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _blob_path(content_hash):
+    return os.path.join(_blobs_dir(), f"{content_hash}.{WORKING_SIZE}.jpg")
+
+
+def _scan_total():
+    total = 0
+    for name in os.listdir(_blobs_dir()):
+        path = os.path.join(_blobs_dir(), name)
+        try:
+            if name.endswith(".orig"):
+                os.remove(path)  # ไฟล์จากเวอร์ชันก่อน ไม่มีใครอ่านแล้ว
+            else:
+                total += os.path.getsize(path)
+        except OSError: pass
+    return total
+
+
+def _ensure_dirs():
+    global _total_bytes
+    if _total_bytes is None:
+        os.makedirs(_keys_dir(), exist_ok=True)
+        os.makedirs(_blobs_dir(), exist_ok=True)
+        _total_bytes = _scan_total()
+
+
+def _evict():
+    """Drop least-recently-used blobs until the cache is back under 90% of budget."""
+    global _total_bytes
+    if _total_bytes <= CACHE_BUDGET_BYTES:
+        return
+    entries = []
+    for name in os.listdir(_blobs_dir()):
+        path = os.path.join(_blobs_dir(), name)
+        try: st = os.stat(path)
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, path))
+    target = CACHE_BUDGET_BYTES * 0.9
+    for _, size, path in sorted(entries):
+        if _total_bytes <= target:
+            break
+        try: os.remove(path)
+        except OSError: continue
+        _total_bytes -= size
+    # keys/ ที่ชี้ไปยัง blob ที่ถูกลบแล้วจะกลายเป็น miss เองตอน load()
+
+
+def open_reduced(src, max_side=WORKING_SIZE):
+    """Open bytes or a file object and decode it straight to RGB at <= max_side px.
+
+    For JPEGs draft() makes libjpeg decode at 1/2, 1/4 or 1/8 scale, so a 4000px
+    product photo is never decoded at full resolution.
+    """
+    img = Image.open(BytesIO(src) if isinstance(src, (bytes, bytearray)) else src)
+    if img.format == "JPEG":
+        img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGB") if img.mode != "RGB" else img
+    img.load()
+    img.thumbnail((max_side, max_side))
+    return img
+
+
+def make_working_copy(img, max_side=WORKING_SIZE, quality=WORKING_QUALITY):
+    """Downscale to max_side and encode as RGB JPEG bytes."""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img = img.copy()
+    img.thumbnail((max_side, max_side))
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def load(key):
+    """Return the cached 1024px working copy for key as a PIL image, or None on a miss."""
+    with _lock:
+        _ensure_dirs()
+        try:
+            with open(os.path.join(_keys_dir(), key)) as f:
+                content_hash = f.read().strip()
+        except OSError:
+            return None
+        working_path = _blob_path(content_hash)
+        try:
+            with open(working_path, "rb") as f:
+                data = f.read()
+            os.utime(working_path)
+        except OSError:
+            return None
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img
+
+
+def store(key, downloaded):
+    """Cache the working copy of the downloaded bytes under key and return it decoded (1024px)."""
+    global _total_bytes
+    working_bytes = make_working_copy(open_reduced(downloaded))
+    content_hash = hashlib.sha256(downloaded).hexdigest()
+    working_path = _blob_path(content_hash)
+    with _lock:
+        _ensure_dirs()
+        if not os.path.exists(working_path):
+            _write_atomic(working_path, working_bytes)
+            _total_bytes += len(working_bytes)
+        _write_atomic(os.path.join(_keys_dir(), key), content_hash.encode())
+        _evict()
+    working = Image.open(BytesIO(working_bytes))
+    working.load()
+    return working
+
+
+def usage():
+    """(bytes used, byte budget) of the cache."""
+    with _lock:
+        _ensure_dirs()
+        return _total_bytes, CACHE_BUDGET_BYTES
@@ -0,0 +1,89 @@
+"""Choose which reference images of one slot are worth sending to Gemini.
+
+Every image gets a 128-bit difference hash (dHash: signs of the horizontal and
+vertical brightness gradients of an 8x8 grid), so similar pictures have hashes a
+few bits apart regardless of size, compression or colour.
+
+Going through the slot in gallery order, an image within DUPLICATE_DISTANCE bits
+of one already kept is dropped as a near-duplicate (same angle, colour variant of
+the same design). If more than max_images are left, the most distinct ones are
+kept: the first image always, then repeatedly the image farthest from everything
+picked so far. The kept images stay in gallery order.
+
+Hashes are cached process-wide per image ID: the Shopify image (id + updated_at)
+for fetched images, the pixel content hash for uploads.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+HASH_SIZE = 8
+DUPLICATE_DISTANCE = int(os.environ.get("DUPLICATE_DISTANCE", "12"))  # bit ที่ต่างกันได้สูงสุดจาก 128
+MAX_PER_SLOT = int(os.environ.get("MAX_REFS_PER_SLOT", "4"))          # 0 = ไม่จำกัด
+CACHE_ITEMS = 20000
+
+_lock = threading.Lock()
+_hashes = OrderedDict()
+
+
+def dhash(img):
+    gray = img.convert("L") if img.mode != "L" else img
+    wide = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX).tobytes()
+    tall = gray.resize((HASH_SIZE, HASH_SIZE + 1), Image.Resampling.BOX).tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            bits = (bits << 1) | (wide[i] > wide[i + 1])
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * HASH_SIZE + col
+            bits = (bits << 1) | (tall[i] > tall[i + HASH_SIZE])
+    return bits
+
+
+def cached_hash(img, image_id):
+    with _lock:
+        value = _hashes.get(image_id)
+        if value is not None:
+            _hashes.move_to_end(image_id)
+            return value
+    value = dhash(img)
+    with _lock:
+        _hashes[image_id] = value
+        while len(_hashes) > CACHE_ITEMS:
+            _hashes.popitem(last=False)
+    return value
+
+
+def distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def select(imgs, image_ids, max_images=MAX_PER_SLOT, duplicate_distance=DUPLICATE_DISTANCE):
+    """Indices of the images to keep plus {dropped index: reason}.
+
+    max_images=0 keeps every distinct image; duplicate_distance=-1 turns off the duplicate check.
+    """
+    hashes = [cached_hash(img, image_id) for img, image_id in zip(imgs, image_ids)]
+    kept, dropped = [], {}
+    for i, h in enumerate(hashes):
+        twin = next((k for k in kept if distance(h, hashes[k]) <= duplicate_distance), None)
+        if twin is None:
+            kept.append(i)
+        else:
+            dropped[i] = f"near-duplicate of #{twin + 1}"
+
+    if max_images and len(kept) > max_images:
+        picked = kept[:1]
+        rest = kept[1:]
+        while len(picked) < max_images:
+            far = max(rest, key=lambda i: min(distance(hashes[i], hashes[p]) for p in picked))
+            picked.append(far)
+            rest.remove(far)
+        for i in rest:
+            dropped[i] = f"over the limit of {max_images}"
+        kept = sorted(picked)
+    return kept, dropped
@@ -0,0 +1,82 @@
+"""In-process background job scheduler for the slow Gemini calls.
+
+The Streamlit script only submits a job and keeps its ID in st.session_state
+(mirrored into the URL so a browser refresh can pick it up again). The work runs
+on a process-wide thread pool and the page polls get() for the status/result.
+
+Job functions follow the helpers convention and return (result, error).
+Finished jobs are kept for RESULT_TTL seconds, then dropped from the result store.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = 4
+RESULT_TTL = 60 * 60  # วินาทีที่เก็บผลลัพธ์ไว้หลังงานเสร็จ
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class Job:
+    def __init__(self, kind, label, meta=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.label = label
+        self.meta = meta or {}
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_jobs = {}
+_lock = threading.Lock()
+
+
+def _run(job, fn, args, kwargs):
+    job.status, job.started = RUNNING, time.time()
+    try:
+        job.result, job.error = fn(*args, **kwargs)
+    except Exception as e:
+        job.result, job.error = None, str(e)
+    job.finished = time.time()
+    job.status = DONE if job.result else FAILED  # None / [] / b"" = ไม่มีผลลัพธ์
+
+
+def _purge():
+    cutoff = time.time() - RESULT_TTL
+    with _lock:
+        for job_id in [j.id for j in _jobs.values() if j.finished and j.finished < cutoff]:
+            del _jobs[job_id]
+
+
+def submit(fn, *args, kind="", label="", meta=None, **kwargs):
+    """Queue fn(*args, **kwargs) on the worker pool and return the new job ID.
+
+    meta is free-form data for whoever picks up the result (not passed to fn).
+    """
+    _purge()
+    job = Job(kind, label, meta)
+    with _lock:
+        _jobs[job.id] = job
+    _executor.submit(_run, job, fn, args, kwargs)
+    return job.id
+
+
+def get(job_id):
+    """The Job for job_id, or None if it is unknown or has expired."""
+    with _lock:
+        return _jobs.get(job_id)
@@ -0,0 +1,101 @@
+"""Read-only indexes over one version of the prompt library.
+
+Built once per library version (library_store.index()) and shared by every
+session, so filtering, searching and paging cost no scan of the whole library
+on each rerun:
+
+- by id, by category (ids sorted by name) and all ids sorted by name
+- full-text: every word of name, category, template and variables maps to the
+  templates containing it. A query matches templates that contain every query
+  word, each as a prefix ("gol ring" finds "Gold Ring Luxury").
+"""
+import bisect
+import re
+import uuid
+
+WORD = re.compile(r"\w+")
+
+
+def words(text):
+    return WORD.findall(str(text or "").lower())
+
+
+def new_template_id(taken=()):
+    """A random id that is not in taken (ids never depend on the library size)."""
+    while True:
+        template_id = f"t{uuid.uuid4().hex[:10]}"
+        if template_id not in taken:
+            return template_id
+
+
+def unique_ids(library):
+    """(library, changed): templates without an id or with a duplicate id get a new one."""
+    seen, out, changed = set(), [], False
+    for p in library:
+        template_id = str(p.get("id") or "")
+        if not template_id or template_id in seen:
+            p = {**p, "id": new_template_id(seen)}
+            template_id, changed = p["id"], True
+        seen.add(template_id)
+        out.append(p)
+    return out, changed
+
+
+class LibraryIndex:
+    def __init__(self, library):
+        self.by_id = {str(p["id"]): p for p in library}
+        order = sorted(self.by_id, key=lambda i: (str(self.by_id[i].get("name", "")).lower(), i))
+        self.rank = {template_id: n for n, template_id in enumerate(order)}
+        self.all_ids = order
+        self.by_category = {}
+        postings = {}
+        for template_id in order:
+            p = self.by_id[template_id]
+            self.by_category.setdefault(p.get("category") or "", []).append(template_id)
+            text = " ".join(str(p.get(field, "")) for field in ("name", "category", "template", "variables"))
+            for word in set(words(text)):
+                postings.setdefault(word, set()).add(template_id)
+        self.postings = postings
+        self.vocabulary = sorted(postings)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, template_id):
+        return self.by_id.get(str(template_id))
+
+    @property
+    def categories(self):
+        return sorted(c for c in self.by_category if c)
+
+    def _prefix_matches(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        found = set()
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            found |= self.postings[word]
+        return found
+
+    def search(self, query="", category=None):
+        """Ids sorted by name, filtered by category (None = all) and query words."""
+        ids = self.by_category.get(category, []) if category is not None else self.all_ids
+        query_words = words(query)
+        if not query_words:
+            return list(ids)
+        hits = None
+        for word in sorted(set(query_words), key=len, reverse=True):  # คำยาวมักได้ชุดเล็ก -> ตัดเร็ว
+            matches = self._prefix_matches(word)
+            hits = matches if hits is None else hits & matches
+            if not hits:
+                return []
+        if category is not None:
+            hits = {i for i in hits if (self.by_id[i].get("category") or "") == category}
+        return sorted(hits, key=self.rank.get)
+
+
+def page(ids, number, size):
+    """(ids on page `number` (1-based, clamped), page count)."""
+    pages = max(1, -(-len(ids) // size))
+    number = min(max(1, number), pages)
+    return ids[(number - 1) * size:number * size], pages
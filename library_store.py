@@ -0,0 +1,296 @@
+"""Process-wide prompt library with TTL refresh and write-behind to JSONBin.
+
+Every session reads the same in-memory copy, so opening the app costs no JSONBin
+round trip once the process has loaded the library. After LIBRARY_TTL it is
+refreshed in the background; JSONBin's ETag is sent as If-None-Match so an
+unchanged bin is not downloaded again.
+
+Saves only update memory and schedule a flush WRITE_DELAY seconds later, so a
+burst of edits turns into one PUT. Before writing, the flush re-reads the bin. If
+somebody else changed it since our last sync, the two versions are merged per
+template id. When both sides changed the same template, ours wins and the
+template's name is reported in status()["conflicts"].
+
+The library (with our last synced copy and any unsaved edits) is also kept in a
+local snapshot file, replaced atomically on every change. A new process starts
+from the snapshot without waiting for JSONBin and refreshes in the background.
+Without a snapshot the first load waits at most FIRST_LOAD_WAIT seconds and then
+starts from DEFAULT_PROMPTS until JSONBin answers.
+
+Every template has a unique id (missing or duplicate ids are replaced on load).
+index() returns a LibraryIndex of the current version, built once per version and
+shared read-only by every session; single templates are changed with
+upsert_template() / delete_template() instead of saving the whole list.
+"""
+import atexit
+import copy
+import json
+import os
+import threading
+import time
+
+from helpers import DEFAULT_PROMPTS, JSONBIN_NOT_CONFIGURED, fetch_prompts_remote, put_prompts_remote
+from library_index import LibraryIndex, new_template_id, unique_ids
+
+LIBRARY_TTL = 300       # วินาทีก่อน refresh จาก JSONBin (ทำใน background)
+WRITE_DELAY = 3.0       # รวม save ที่เกิดในช่วงนี้เป็น PUT เดียว
+RETRY_DELAY = 30.0      # ถ้า flush ล้มเหลว ลองใหม่หลังจากนี้
+FIRST_LOAD_WAIT = 1.0   # วินาทีที่รอ JSONBin ตอนเริ่ม process ถ้ายังไม่มี snapshot
+SNAPSHOT_PATH = os.environ.get("LIBRARY_SNAPSHOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "library.json"))
+
+
+def merge_library(base, ours, theirs):
+    """Three-way merge of template lists by id. Returns (merged, conflicting names)."""
+    b = {p.get("id"): p for p in base}
+    o = {p.get("id"): p for p in ours}
+    t = {p.get("id"): p for p in theirs}
+    ids = list(o) + [i for i in t if i not in o]
+    merged, conflicts = [], []
+    for i in ids:
+        bp, op, tp = b.get(i), o.get(i), t.get(i)
+        if op == tp or tp == bp:
+            pick = op
+        elif op == bp:
+            pick = tp
+        else:
+            pick = op if op is not None else tp  # แก้ทั้งสองฝั่ง: ของเราชนะ, ลบ vs แก้: เก็บฉบับที่แก้
+            conflicts.append((op or tp).get("name", str(i)))
+        if pick is not None:
+            merged.append(pick)
+    return merged, conflicts
+
+
+class LibraryStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.library = None     # ฉบับปัจจุบันที่ทุก session เห็น
+        self.base = None        # ฉบับล่าสุดที่ตรงกับบน JSONBin (ใช้ตอน merge)
+        self.etag = None
+        self.loaded_at = 0.0
+        self.version = 0
+        self.dirty = False
+        self.timer = None
+        self.refreshing = False
+        self.last_sync = None
+        self.last_error = None
+        self.conflicts = []
+        self.source = None      # "snapshot" / "remote" / "default": ที่มาของฉบับปัจจุบัน
+        self.first_load = None  # thread ที่โหลดครั้งแรกจาก JSONBin
+        self.indexed = None     # (version, LibraryIndex)
+
+    def _load_snapshot(self):
+        try:
+            with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(snap.get("library"), list):
+            return False
+        self.library, fixed = unique_ids(snap["library"])
+        self.base = snap.get("base")
+        self.etag = snap.get("etag")
+        self.dirty = bool(snap.get("dirty")) or fixed
+        self.loaded_at = 0.0  # ถือว่าเก่าแล้ว -> get() refresh ใน background ทันที
+        self.source = "snapshot"
+        self.version += 1
+        if self.dirty:
+            self._schedule(WRITE_DELAY)  # edit ที่ยังไม่ได้ส่งก่อน process เดิมปิด
+        return True
+
+    def _write_snapshot(self):
+        """Atomically replace the snapshot file with the current state (call with the lock held)."""
+        snap = {"library": self.library, "base": self.base, "etag": self.etag, "dirty": self.dirty, "saved_at": time.time()}
+        try:
+            os.makedirs(os.path.dirname(SNAPSHOT_PATH), exist_ok=True)
+            tmp = f"{SNAPSHOT_PATH}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snap, f, ensure_ascii=False)
+            os.replace(tmp, SNAPSHOT_PATH)
+        except OSError:
+            pass  # snapshot เป็นแค่ตัวช่วยตอนเริ่ม process
+
+    def _apply_remote(self, record, etag):
+        with self.lock:
+            self.loaded_at = time.time()
+            if record is None or self.dirty:
+                return  # 304 หรือมี local edit รอ flush อยู่ (flush จะ merge เอง)
+            self.etag = etag
+            self.base = copy.deepcopy(record)
+            self.source = "remote"
+            record, fixed = unique_ids(record)
+            if record != self.library:
+                self.library = record
+                self.version += 1
+            if fixed:
+                # id ซ้ำ/ไม่มี id บน JSONBin -> เขียน id ใหม่กลับไป
+                self.dirty = True
+                self._schedule(WRITE_DELAY)
+            self._write_snapshot()
+
+    def _refresh(self):
+        record, etag, err = fetch_prompts_remote(self.etag)
+        if err and err != JSONBIN_NOT_CONFIGURED:
+            self.last_error = err
+        self._apply_remote(record, etag)
+        with self.lock:
+            self.refreshing = False
+            if err is None and record is None and self.library is not None:
+                self.source = "remote"  # 304: snapshot ตรงกับบน JSONBin
+            if self.library is None:
+                self.library = copy.deepcopy(DEFAULT_PROMPTS)
+                self.source = "default"
+                self.version += 1
+
+    def start(self):
+        """Begin loading without blocking: the snapshot now, JSONBin in the background."""
+        with self.lock:
+            if self.library is not None or self.first_load is not None:
+                return
+            if self._load_snapshot():
+                return
+            self.refreshing = True
+            self.first_load = threading.Thread(target=self._refresh, daemon=True)
+            self.first_load.start()
+
+    def index(self):
+        """LibraryIndex of the current version (shared, do not modify the templates)."""
+        self.get()
+        with self.lock:
+            if self.indexed is None or self.indexed[0] != self.version:
+                self.indexed = (self.version, LibraryIndex(self.library))
+            return self.indexed[1]
+
+    def get(self):
+        """The current library list (shared, do not modify); the first call in a process without a snapshot waits up to FIRST_LOAD_WAIT."""
+        self.start()
+        if self.first_load is not None and self.library is None:
+            self.first_load.join(FIRST_LOAD_WAIT)
+        with self.lock:
+            if self.library is None:
+                # JSONBin ยังไม่ตอบ -> เริ่มด้วย default, ฉบับจริงมาแทนเมื่อ refresh เสร็จ (version เปลี่ยน)
+                self.library = copy.deepcopy(DEFAULT_PROMPTS)
+                self.source = "default"
+                self.version += 1
+            stale = time.time() - self.loaded_at > LIBRARY_TTL
+            if stale and not self.refreshing and not self.dirty:
+                self.refreshing = True
+                threading.Thread(target=self._refresh, daemon=True).start()
+            return self.library
+
+    def _changed(self):
+        self.version += 1
+        self.dirty = True
+        self._write_snapshot()
+        self._schedule(WRITE_DELAY)
+
+    def upsert_template(self, template):
+        """Replace the template with the same id, or add it (with a new id if it has none). Returns the id."""
+        self.get()
+        with self.lock:
+            template = copy.deepcopy(template)
+            ids = [p.get("id") for p in self.library]
+            if not template.get("id"):
+                template["id"] = new_template_id(set(ids))
+            library = list(self.library)  # สร้าง list ใหม่ -> index/ผู้อ่านที่ถือฉบับเดิมไม่เห็นการเปลี่ยนกลางทาง
+            if template["id"] in ids:
+                library[ids.index(template["id"])] = template
+            else:
+                library.append(template)
+            self.library = library
+            self._changed()
+            return template["id"]
+
+    def delete_template(self, template_id):
+        self.get()
+        with self.lock:
+            library = [p for p in self.library if p.get("id") != template_id]
+            if len(library) != len(self.library):
+                self.library = library
+                self._changed()
+
+    def _schedule(self, delay):
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write pending changes now (merging with any remote change since the last sync)."""
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+            local = copy.deepcopy(self.library)
+            base = self.base
+            self.dirty = False
+
+        remote, _, err = fetch_prompts_remote()
+        if err is None:
+            merged, conflicts = local, []
+            if remote != base:
+                # base None = ยังไม่เคย sync (เริ่มจาก default) -> รวมกับของบน JSONBin ไม่ใช่เขียนทับ
+                merged, conflicts = merge_library(base or [], local, remote)
+            ok, err = put_prompts_remote(merged)
+
+        with self.lock:
+            if err == JSONBIN_NOT_CONFIGURED:
+                return  # local mode: เก็บไว้ใน memory อย่างเดียว
+            if err:
+                self.last_error = err
+                self.dirty = True
+                self._schedule(RETRY_DELAY)
+                return
+            self.base = copy.deepcopy(merged)
+            self.etag = None
+            self.last_sync = time.time()
+            self.last_error = None
+            self.conflicts = conflicts
+            if self.dirty:
+                # มี save ใหม่เข้ามาระหว่าง flush -> เอาส่วนที่ merge มาจาก remote ไปรวมด้วย
+                self.library, more = merge_library(local, self.library, merged)
+                self.conflicts += more
+                self.version += 1
+            elif merged != self.library:
+                self.library = merged
+                self.version += 1
+            self._write_snapshot()
+
+    def status(self):
+        with self.lock:
+            return {
+                "version": self.version,
+                "pending": self.dirty,
+                "last_sync": self.last_sync,
+                "last_error": self.last_error,
+                "conflicts": list(self.conflicts),
+                "source": self.source,
+                "refreshing": self.refreshing,
+            }
+
+
+_store = LibraryStore()
+atexit.register(_store.flush)
+
+
+def start():
+    _store.start()
+
+
+def index():
+    return _store.index()
+
+
+def upsert_template(template):
+    return _store.upsert_template(template)
+
+
+def delete_template(template_id):
+    _store.delete_template(template_id)
+
+
+def flush():
+    _store.flush()
+
+
+def status():
+    return _store.status()
@@ -0,0 +1,152 @@
+"""Storefront-ready variants of a generated image, encoded in parallel worker processes.
+
+Gemini returns a large PNG or JPEG. Besides "original" (the bytes unchanged) every
+image gets progressive JPEG and WebP variants at full size and at each of
+STOREFRONT_WIDTHS narrower than the image, named like "jpeg", "webp-1024".
+Each variant is kept under TARGET_BYTES where possible: quality is binary-searched
+in QUALITY_STEP steps between MIN_QUALITY and MAX_QUALITY, and a variant that does
+not fit even at MIN_QUALITY is kept at MIN_QUALITY.
+
+Variants are encoded in parallel on a thread pool: Pillow releases the GIL while
+it resizes and encodes. (A forked process pool is not safe inside the
+multithreaded Streamlit server; a child can inherit a lock held by another
+thread and hang.) Results are stored with result_cache's code, keyed by the sha256
+of the source bytes, so each variant is encoded once, whichever session asks for
+it. They go in their own CACHE_DIR with their own CACHE_BUDGET_BYTES, so variants
+never evict the paid Gemini results.
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+import result_cache
+
+ORIGINAL = "original"
+FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+STOREFRONT_WIDTHS = (2048, 1600, 1024)
+TARGET_BYTES = int(float(os.environ.get("OUTPUT_TARGET_KB", "500")) * 1024)
+MIN_QUALITY, MAX_QUALITY = 55, 90
+QUALITY_STEP = 5
+OUTPUT_WORKERS = min(4, os.cpu_count() or 1)
+CACHE_DIR = os.environ.get("OUTPUT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "variants"))
+CACHE_BUDGET_BYTES = int(os.environ.get("OUTPUT_CACHE_MB", "128")) * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parse(name):
+    """(format key, width or None) of a variant name such as "webp-1024"."""
+    fmt, _, width = name.partition("-")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown variant '{name}'")
+    return fmt, int(width) if width else None
+
+
+def names_for(size):
+    """Variant names that make sense for an image of size (width, height), original first."""
+    widths = [None] + [w for w in STOREFRONT_WIDTHS if w < size[0]]
+    return [ORIGINAL] + [fmt if w is None else f"{fmt}-{w}" for w in widths for fmt in FORMATS]
+
+
+def mime_type(name, data=None):
+    if name == ORIGINAL:
+        return Image.MIME.get(Image.open(BytesIO(data)).format, "image/jpeg") if data else "image/jpeg"
+    return FORMATS[parse(name)[0]]
+
+
+def extension(name, data=None):
+    return mime_type(name, data).split("/")[-1].replace("jpeg", "jpg")
+
+
+def encode(data, name, target_bytes=TARGET_BYTES):
+    """Encode one variant (runs on a worker thread). Returns bytes."""
+    fmt, width = parse(name)
+    img = Image.open(BytesIO(data))
+    img.load()
+    if width and img.width > width:
+        img = img.resize((width, round(img.height * width / img.width)), Image.Resampling.LANCZOS)
+    if fmt == "jpeg" and img.mode != "RGB":
+        # JPEG ไม่มี alpha -> วางบนพื้นขาว
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img.convert("RGBA"), mask=img.convert("RGBA").getchannel("A"))
+        img = flat
+
+    def save(quality):
+        buf = BytesIO()
+        if fmt == "jpeg":
+            img.save(buf, format="JPEG", quality=quality, progressive=True, optimize=True)
+        else:
+            img.save(buf, format="WEBP", quality=quality, method=4)
+        return buf.getvalue()
+
+    best = save(MAX_QUALITY)
+    if len(best) <= target_bytes:
+        return best
+    # binary search บนขั้นละ QUALITY_STEP -> ไม่เกิน 3 encode เพิ่ม
+    steps = list(range(MIN_QUALITY, MAX_QUALITY, QUALITY_STEP))
+    best, low, high = None, 0, len(steps) - 1
+    while low <= high:
+        mid = (low + high) // 2
+        out = save(steps[mid])
+        if len(out) <= target_bytes:
+            best, low = out, mid + 1
+        else:
+            high = mid - 1
+    return best or save(MIN_QUALITY)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=OUTPUT_WORKERS, thread_name_prefix="variants")
+        return _pool
+
+
+def _key(source_hash, name, target_bytes):
+    return result_cache.fingerprint("variant", source_hash, name, target_bytes)
+
+
+def cached(data, name, target_bytes=TARGET_BYTES):
+    """The variant if it was already encoded, else None (never encodes)."""
+    if name == ORIGINAL:
+        return data
+    return result_cache.get(_key(hashlib.sha256(data).hexdigest(), name, target_bytes), CACHE_DIR)
+
+
+def encode_many(data, names, target_bytes=TARGET_BYTES):
+    """{name: bytes} for the requested variants; the ones not cached are encoded in parallel."""
+    source_hash = hashlib.sha256(data).hexdigest()
+    out = {ORIGINAL: data} if ORIGINAL in names else {}
+    missing = []
+    for name in names:
+        if name == ORIGINAL: continue
+        hit = result_cache.get(_key(source_hash, name, target_bytes), CACHE_DIR)
+        if hit: out[name] = hit
+        else: missing.append(name)
+    if not missing:
+        return out
+
+    pool = _get_pool()
+    futures = {name: pool.submit(encode, data, name, target_bytes) for name in missing}
+    encoded = {name: fut.result() for name, fut in futures.items()}
+    for name, variant in encoded.items():
+        result_cache.put(_key(source_hash, name, target_bytes), variant, CACHE_DIR, CACHE_BUDGET_BYTES)
+    out.update(encoded)
+    return out
+
+
+def get(data, name, target_bytes=TARGET_BYTES):
+    """One variant of data, from the cache or encoded now."""
+    return encode_many(data, [name], target_bytes)[name]
+
+
+def warm(data):
+    """Encode every variant of data in the background so later get() calls are cache hits."""
+    names = names_for(Image.open(BytesIO(data)).size)
+    threading.Thread(target=encode_many, args=(data, names), name="variants", daemon=True).start()
@@ -0,0 +1,160 @@
+"""Fit the reference images of one Gemini request into a byte / token budget.
+
+Every reference starts at the best level of LEVELS (1024px, q90, as before).
+While the payload is over budget, the reference with the largest weighted share
+drops one level. The first image of each slot (its primary reference) counts
+PRIMARY_WEIGHT times less, so extra gallery shots of a product lose resolution
+and quality long before the main shot does.
+
+Sizes at lower levels are estimated from the real top-level size (area and a JPEG
+quality factor). The estimates are then calibrated against the sizes of the
+references actually encoded at lower levels and the plan is made once more, so a
+plan needs about two encodes per reference. If the real size is still over budget,
+the largest references keep stepping down until it fits.
+The payload only exceeds the budget when every reference is at the lowest level.
+"""
+import math
+import os
+
+LEVELS = [(1024, 90), (1024, 85), (896, 85), (768, 85), (768, 80), (640, 80), (512, 80), (512, 75), (384, 75)]
+QUALITY_FACTOR = {90: 1.0, 85: 0.8, 80: 0.68, 75: 0.6}  # ขนาด JPEG โดยประมาณเทียบกับ q90
+PRIMARY_WEIGHT = 3.0
+BUDGET_BYTES = int(float(os.environ.get("PAYLOAD_BUDGET_MB", "8")) * 1024 * 1024)   # base64 ของรูปอ้างอิงรวมกัน
+BUDGET_TOKENS = int(os.environ.get("PAYLOAD_BUDGET_TOKENS", "0")) or None
+TILE = 768
+TOKENS_PER_TILE = 258
+
+
+def scaled_size(size, max_side):
+    w, h = size
+    scale = min(1.0, max_side / max(w, h))
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def image_tokens(width, height):
+    """Gemini's input token estimate: one tile for small images, else one per 768px tile."""
+    if max(width, height) <= 384:
+        return TOKENS_PER_TILE
+    return TOKENS_PER_TILE * math.ceil(width / TILE) * math.ceil(height / TILE)
+
+
+class Reference:
+    def __init__(self, slot, img, primary):
+        self.slot = slot
+        self.img = img
+        self.primary = primary
+        self.level = 0
+        self.data = None
+        self.top_bytes = 0
+        self.scale = 1.0   # ขนาดจริง / ค่าประมาณ ของระดับที่ต่ำกว่า top level
+
+    @property
+    def side(self):
+        return LEVELS[self.level][0]
+
+    @property
+    def quality(self):
+        return LEVELS[self.level][1]
+
+    def estimate(self):
+        top_side = min(LEVELS[0][0], max(self.img.size))
+        area = (min(self.side, max(self.img.size)) / top_side) ** 2
+        estimate = self.top_bytes * area * QUALITY_FACTOR[self.quality] / QUALITY_FACTOR[LEVELS[0][1]]
+        return estimate * self.scale if self.level else estimate
+
+    def tokens(self):
+        return image_tokens(*scaled_size(self.img.size, self.side))
+
+
+class Plan:
+    """Encoded references plus what it cost: bytes, estimated tokens, levels used."""
+
+    def __init__(self, refs, budget_bytes, budget_tokens):
+        self.refs = refs
+        self.budget_bytes = budget_bytes
+        self.budget_tokens = budget_tokens
+
+    @property
+    def parts(self):
+        return [r.data for r in self.refs]
+
+    @property
+    def levels(self):
+        return [[r.side, r.quality] for r in self.refs]
+
+    @property
+    def total_bytes(self):
+        return sum(len(r.data) for r in self.refs)
+
+    @property
+    def tokens(self):
+        return sum(r.tokens() for r in self.refs)
+
+    @property
+    def downscaled(self):
+        return sum(1 for r in self.refs if r.level)
+
+    @property
+    def over_budget(self):
+        return _over(self.refs, self.total_bytes, self.budget_bytes, self.budget_tokens)
+
+    def summary(self):
+        text = (f"{len(self.refs)} refs · {self.total_bytes / 2**20:.1f}/{self.budget_bytes / 2**20:.1f} MB"
+                f" · ~{self.tokens:,} tokens")
+        if self.downscaled:
+            text += f" · {self.downscaled} reduced"
+        if self.over_budget:
+            text += " · over budget"
+        return text
+
+
+def _over(refs, total_bytes, budget_bytes, budget_tokens):
+    return total_bytes > budget_bytes or (budget_tokens is not None and sum(r.tokens() for r in refs) > budget_tokens)
+
+
+def _step_down(refs, size_of):
+    """Drop the reference with the largest weighted size one level; None if all are at the bottom."""
+    candidates = [r for r in refs if r.level < len(LEVELS) - 1]
+    if not candidates:
+        return None
+    ref = max(candidates, key=lambda r: size_of(r) / (PRIMARY_WEIGHT if r.primary else 1.0))
+    ref.level += 1
+    return ref
+
+
+def _fit_estimates(refs, encode, budget_bytes, budget_tokens):
+    while _over(refs, sum(r.estimate() for r in refs), budget_bytes, budget_tokens):
+        if _step_down(refs, Reference.estimate) is None:
+            break
+    for r in refs:
+        if r.level:
+            r.data = encode(r.img, r.side, r.quality)
+
+
+def plan(references, encode, budget_bytes=None, budget_tokens=None):
+    """Encode references [(slot, PIL image, is_primary)] to fit the budget.
+
+    encode(img, max_side, quality) -> base64 str. Returns a Plan in the same order.
+    """
+    budget_bytes = budget_bytes or BUDGET_BYTES
+    budget_tokens = budget_tokens or BUDGET_TOKENS
+    refs = [Reference(slot, img, primary) for slot, img, primary in references]
+    for r in refs:
+        r.data = encode(r.img, r.side, r.quality)
+        r.top_bytes = len(r.data)
+
+    _fit_estimates(refs, encode, budget_bytes, budget_tokens)
+    reduced = [r for r in refs if r.level]
+    if reduced:
+        ratio = sum(len(r.data) for r in reduced) / sum(r.estimate() for r in reduced)
+        for r in refs:
+            r.scale, r.level = ratio, 0
+            r.data = encode(r.img, r.side, r.quality)
+        _fit_estimates(refs, encode, budget_bytes, budget_tokens)
+
+    while _over(refs, sum(len(r.data) for r in refs), budget_bytes, budget_tokens):
+        r = _step_down(refs, lambda r: len(r.data))
+        if r is None:
+            break
+        r.data = encode(r.img, r.side, r.quality)
+    return Plan(refs, budget_bytes, budget_tokens)
@@ -0,0 +1,79 @@
+"""Crop-edit-composite: edit only a rectangle of an image and paste the result back.
+
+The marked rectangle is padded with CONTEXT of its size on every side (so the
+model sees what surrounds it), cropped and scaled to WORK_SIDE on the long side
+before it is sent. The patch that comes back is scaled to the crop size and
+blended into the original: full strength inside the marked rectangle, fading
+linearly to nothing across the padding. Pixels outside the padded crop are never
+touched, and the result is PNG so they stay identical to the original.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+CONTEXT = 0.25        # ขอบที่เพิ่มรอบสี่เหลี่ยมที่เลือก (สัดส่วนของขนาดสี่เหลี่ยม)
+MIN_CONTEXT = 16      # px
+WORK_SIDE = 1024      # ด้านยาวของ crop ที่ส่งให้ Gemini
+PATCH_QUALITY = 92
+
+
+def _ramp(length, start_fade, end_fade):
+    """0-255 per position: rises over start_fade px, flat, falls over end_fade px."""
+    values = []
+    for i in range(length):
+        a = 1.0
+        if start_fade: a = min(a, (i + 0.5) / start_fade)
+        if end_fade: a = min(a, (length - i - 0.5) / end_fade)
+        values.append(round(255 * a))
+    return bytes(values)
+
+
+class Region:
+    """One marked rectangle of an image: box is (left, top, right, bottom) in pixels of img."""
+
+    def __init__(self, img, box):
+        w, h = img.size
+        left, top, right, bottom = (int(round(v)) for v in box)
+        left, right = sorted((max(0, min(w, left)), max(0, min(w, right))))
+        top, bottom = sorted((max(0, min(h, top)), max(0, min(h, bottom))))
+        if right - left < 2 or bottom - top < 2:
+            raise ValueError("Region is too small")
+        self.img = img
+        self.box = (left, top, right, bottom)
+        pad_x = max(MIN_CONTEXT, round((right - left) * CONTEXT))
+        pad_y = max(MIN_CONTEXT, round((bottom - top) * CONTEXT))
+        self.crop_box = (max(0, left - pad_x), max(0, top - pad_y), min(w, right + pad_x), min(h, bottom + pad_y))
+
+    @property
+    def crop_size(self):
+        return self.crop_box[2] - self.crop_box[0], self.crop_box[3] - self.crop_box[1]
+
+    def patch(self):
+        """The padded crop at WORK_SIDE px on the long side, as JPEG bytes."""
+        cw, ch = self.crop_size
+        scale = WORK_SIDE / max(cw, ch)
+        crop = self.img.crop(self.crop_box).convert("RGB")
+        crop = crop.resize((max(1, round(cw * scale)), max(1, round(ch * scale))), Image.Resampling.LANCZOS)
+        buf = BytesIO()
+        crop.save(buf, format="JPEG", quality=PATCH_QUALITY)
+        return buf.getvalue()
+
+    def mask(self):
+        cw, ch = self.crop_size
+        left, top, right, bottom = self.box
+        cl, ct, cr, cb = self.crop_box
+        # ด้านที่ชนขอบรูปไม่มี padding -> ไม่ต้อง fade
+        xs = Image.frombytes("L", (cw, 1), _ramp(cw, left - cl, cr - right)).resize((cw, ch), Image.Resampling.NEAREST)
+        ys = Image.frombytes("L", (1, ch), _ramp(ch, top - ct, cb - bottom)).resize((cw, ch), Image.Resampling.NEAREST)
+        return ImageChops.multiply(xs, ys)
+
+    def composite(self, patch_bytes):
+        """The original with the edited patch blended in, as PNG bytes."""
+        patch = Image.open(BytesIO(patch_bytes))
+        mode = self.img.mode if self.img.mode in ("RGB", "RGBA") else "RGB"
+        out = self.img.convert(mode)
+        patch = patch.convert(mode).resize(self.crop_size, Image.Resampling.LANCZOS)
+        out.paste(patch, self.crop_box[:2], self.mask())
+        buf = BytesIO()
+        out.save(buf, format="PNG")
+        return buf.getvalue()
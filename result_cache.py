@@ -0,0 +1,73 @@
+"""Disk cache for Gemini image results, keyed by a fingerprint of the request.
+
+Pressing Generate twice with identical inputs (or again after a browser refresh)
+returns the stored image instead of paying for another 30-60 s call.
+Entries expire after RESULT_TTL_HOURS and the oldest are evicted once the cache
+grows past RESULT_CACHE_MB.
+
+get/put take an optional cache_dir (and put a budget) so cheap derived data, such
+as output_variants, can use the same code with its own directory and budget
+without evicting the Gemini results.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "results"))
+TTL_SECONDS = float(os.environ.get("RESULT_TTL_HOURS", "72")) * 3600
+BUDGET_BYTES = int(os.environ.get("RESULT_CACHE_MB", "256")) * 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def fingerprint(*parts):
+    """sha256 over the JSON form of parts (strings, numbers, lists, dicts)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def _path(key, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, f"{key}.bin")
+
+
+def get(key, cache_dir=None):
+    """Cached bytes for key, or None if missing or older than the TTL."""
+    path = _path(key, cache_dir)
+    try:
+        if time.time() - os.path.getmtime(path) > TTL_SECONDS:
+            os.remove(path)
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def put(key, data, cache_dir=None, budget=None):
+    cache_dir = cache_dir or CACHE_DIR
+    with _lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{_path(key, cache_dir)}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, _path(key, cache_dir))
+        _evict(cache_dir, BUDGET_BYTES if budget is None else budget)
+
+
+def _evict(cache_dir, budget):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".bin"):
+            continue
+        try: st = os.stat(os.path.join(cache_dir, name))
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    for mtime, size, name in sorted(entries):
+        if total <= budget and now - mtime <= TTL_SECONDS:
+            break
+        try: os.remove(os.path.join(cache_dir, name))
+        except OSError: continue
+        total -= size
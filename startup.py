@@ -0,0 +1,43 @@
+"""Cold-start timing of the Streamlit process.
+
+app.py imports this module before anything else and calls mark(phase) as each
+startup phase finishes. Only the first run in a process is measured (later reruns
+find everything imported and loaded). Times are seconds since this module was
+imported; boot is how long the interpreter and Streamlit ran before that. Every
+mark is also recorded as a tracing span named startup.<phase>.
+"""
+import os
+import time
+
+import tracing
+
+_t0 = time.perf_counter()
+_marks = {}   # phase -> วินาทีนับจาก import
+
+
+def process_age():
+    """Seconds since the OS started this process (Linux /proc), or None elsewhere."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+BOOT = process_age()
+
+
+def mark(phase, **tags):
+    """Record that phase finished now; ignored if it was already recorded in this process."""
+    if phase in _marks:
+        return
+    _marks[phase] = time.perf_counter() - _t0
+    tracing.record(f"startup.{phase}", _marks[phase], **tags)
+
+
+def report():
+    """[(phase, seconds since import)] in the order they finished, boot first when known."""
+    return ([("boot", BOOT)] if BOOT is not None else []) + list(_marks.items())
@@ -0,0 +1,172 @@
+"""Small JPEG previews for the UI, made once and shared by every session.
+
+st.image re-encodes PIL images on every rerun and sends them over the websocket.
+Previews made here are encoded once per (image content hash, size), kept in an
+in-memory LRU backed by a disk cache, and passed to st.image as JPEG bytes, which
+Streamlit forwards without re-encoding. JPEG rather than WebP for that reason:
+st.image converts any other byte format back to JPEG/PNG on every call.
+
+Remote template samples (sample_url) are downloaded once through http_client and
+served from the same cache, so the library tab no longer hotlinks every row.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import http_client
+import image_cache
+
+THUMB_SIZE = 256
+THUMB_QUALITY = 80
+MEMORY_ITEMS = 512
+CACHE_DIR = os.environ.get("THUMB_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "thumbs"))
+DISK_BUDGET_BYTES = int(os.environ.get("THUMB_CACHE_MB", "64")) * 1024 * 1024
+FAILED_URL_RETRY = 600  # วินาที ก่อนลองโหลด sample_url ที่เคยพังอีกครั้ง
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+_failed_urls = {}
+_puts_since_evict = 0
+
+
+def _disk_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.jpg")
+
+
+def _get(key):
+    with _lock:
+        data = _memory.get(key)
+        if data is not None:
+            _memory.move_to_end(key)
+            return data
+    try:
+        with open(_disk_path(key), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    _remember(key, data)
+    return data
+
+
+def _remember(key, data):
+    with _lock:
+        _memory[key] = data
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ITEMS:
+            _memory.popitem(last=False)
+
+
+def _put(key, data):
+    global _puts_since_evict
+    _remember(key, data)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{_disk_path(key)}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, _disk_path(key))
+    with _lock:
+        _puts_since_evict += 1
+        if _puts_since_evict < 100:
+            return
+        _puts_since_evict = 0
+    _evict_disk()
+
+
+def _evict_disk():
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        try: st = os.stat(os.path.join(CACHE_DIR, name))
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= DISK_BUDGET_BYTES * 0.9:
+            break
+        try: os.remove(os.path.join(CACHE_DIR, name))
+        except OSError: continue
+        total -= size
+
+
+def _encode(img, size):
+    thumb = img.convert("RGB") if img.mode != "RGB" else img.copy()
+    thumb.thumbnail((size, size))
+    buf = BytesIO()
+    thumb.save(buf, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def for_image(img, content_hash, size=THUMB_SIZE):
+    """JPEG preview bytes of a PIL image; content_hash identifies the pixels."""
+    key = f"{content_hash}-{size}"
+    data = _get(key)
+    if data is None:
+        data = _encode(img, size)
+        _put(key, data)
+    return data
+
+
+def for_bytes(data, size=THUMB_SIZE, content_hash=None):
+    """JPEG preview of encoded image bytes (e.g. a generated result); content_hash defaults to sha256(data)."""
+    key = f"{content_hash or hashlib.sha256(data).hexdigest()}-{size}"
+    preview = _get(key)
+    if preview is None:
+        preview = _encode(image_cache.open_reduced(data, max_side=size), size)
+        _put(key, preview)
+    return preview
+
+
+def _url_key(url, size):
+    return f"{hashlib.sha256(url.encode()).hexdigest()}-{size}"
+
+
+def url_failed(url):
+    """True while a recent download of url failed (it is not retried for FAILED_URL_RETRY seconds)."""
+    return time.time() - _failed_urls.get(url, 0) < FAILED_URL_RETRY
+
+
+def peek_url(url, size=THUMB_SIZE):
+    """Preview of url if it is already cached, else None; never downloads."""
+    return _get(_url_key(url, size))
+
+
+def for_url(url, size=THUMB_SIZE):
+    """JPEG preview bytes of a remote image, or None if it cannot be downloaded/decoded."""
+    key = _url_key(url, size)
+    data = _get(key)
+    if data is not None:
+        return data
+    if url_failed(url):
+        return None
+    try:
+        res = http_client.get(url, timeout=5, headers={"User-Agent": "RingsFinger/1.0"})
+        if res.status_code != 200:
+            raise ValueError(f"HTTP {res.status_code}")
+        data = _encode(image_cache.open_reduced(res.content, max_side=size), size)
+    except Exception:
+        _failed_urls[url] = time.time()
+        return None
+    _put(key, data)
+    return data
+
+
+_background = ThreadPoolExecutor(max_workers=4, thread_name_prefix="thumbs")
+_queued = set()
+
+
+def fetch_later(urls, size=THUMB_SIZE):
+    """Download previews of urls in the background, without waiting (the page shows them on a later rerun)."""
+    def fetch(url):
+        try: for_url(url, size)
+        finally:
+            with _lock: _queued.discard((url, size))
+    for url in dict.fromkeys(urls):
+        if not url or url_failed(url) or peek_url(url, size) is not None:
+            continue
+        with _lock:
+            if (url, size) in _queued: continue
+            _queued.add((url, size))
+        _background.submit(fetch, url)
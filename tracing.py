@@ -0,0 +1,233 @@
+"""Process-wide latency / payload tracing for the helpers that call external services.
+
+Each helper call runs inside a span (@traced(name) or `with span(name)`). A span
+records its wall time and whatever http_client reports while it is open on the
+same thread: request / response bytes, last status code, retries and number of
+HTTP round trips. Nested spans (upload -> graphql) all receive the HTTP numbers.
+Work handed to other threads (hedged attempts) runs under adopt(current()) so the
+caller's spans receive those numbers as well.
+
+Finished spans feed a rolling window of the last WINDOW durations per span name
+(p50/p95/p99) plus running totals, and the last MAX_SPANS spans are kept for the
+JSON-lines export. Set TRACE_LOG=path to also append every span to a file.
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW = 500
+MAX_SPANS = 2000
+TRACE_LOG = os.environ.get("TRACE_LOG")
+METRIC_PREFIX = "ringsfinger_span"
+
+_lock = threading.Lock()
+_count_lock = threading.Lock()   # span เดียวกันอาจได้ตัวเลขจากหลาย thread (adopt)
+_local = threading.local()
+_windows = {}          # name -> deque ของ duration ล่าสุด
+_totals = {}           # name -> ผลรวมตั้งแต่เริ่ม process
+_spans = deque(maxlen=MAX_SPANS)
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status = None
+        self.retries = 0
+        self.http_calls = 0
+        self.error = None
+        self.tags = {}
+        self.done = False
+
+    def as_dict(self):
+        return {
+            "name": self.name, "start": round(self.start, 3), "duration": round(self.duration, 4),
+            "request_bytes": self.request_bytes, "response_bytes": self.response_bytes,
+            "status": self.status, "retries": self.retries, "http_calls": self.http_calls,
+            "error": self.error, **self.tags,
+        }
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _finish(s):
+    with _lock:
+        _windows.setdefault(s.name, deque(maxlen=WINDOW)).append(s.duration)
+        t = _totals.setdefault(s.name, {"count": 0, "seconds": 0.0, "errors": 0, "retries": 0,
+                                        "request_bytes": 0, "response_bytes": 0})
+        t["count"] += 1
+        t["seconds"] += s.duration
+        t["errors"] += bool(s.error)
+        t["retries"] += s.retries
+        t["request_bytes"] += s.request_bytes
+        t["response_bytes"] += s.response_bytes
+        _spans.append(s)
+        if TRACE_LOG:
+            try:
+                with open(TRACE_LOG, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(s.as_dict(), ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+
+
+class span:
+    """Context manager that times a block as one span (yields the Span)."""
+
+    def __init__(self, name):
+        self.span = Span(name)
+
+    def __enter__(self):
+        _stack().append(self.span)
+        self._t0 = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self._t0
+        if exc is not None and self.span.error is None:
+            self.span.error = f"{exc_type.__name__}: {exc}"
+        _stack().remove(self.span)
+        with _count_lock:
+            self.span.done = True  # attempt ที่ยังวิ่งหลังจากนี้ไม่เพิ่มตัวเลขให้ span ที่ export ไปแล้ว
+        _finish(self.span)
+        return False
+
+
+def traced(name, errors=True):
+    """Decorator: run the function inside span(name).
+
+    Helpers return (result, ..., error); a non-empty error marks the span as failed.
+    Pass errors=False for functions whose last return value is not an error.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with span(name) as s:
+                out = fn(*args, **kwargs)
+                if errors and isinstance(out, tuple) and out and isinstance(out[-1], str) and out[-1]:
+                    s.error = out[-1]
+                return out
+        return inner
+    return wrap
+
+
+def current():
+    """The spans open on this thread, to pass to adopt() in a worker thread."""
+    return list(_stack())
+
+
+class adopt:
+    """Context manager for a worker thread: run with the caller's spans (from current()) open."""
+
+    def __init__(self, spans):
+        self.spans = spans
+
+    def __enter__(self):
+        self._saved = _stack()
+        _local.stack = list(self.spans)
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.stack = self._saved
+        return False
+
+
+def record(name, duration, **tags):
+    """Add an already measured span (e.g. a startup phase timed elsewhere)."""
+    s = Span(name)
+    s.start = time.time() - duration
+    s.duration = duration
+    s.tags.update(tags)
+    _finish(s)
+
+
+def annotate(**tags):
+    """Attach tags (e.g. cache="hit") to the innermost open span on this thread."""
+    stack = _stack()
+    if stack:
+        stack[-1].tags.update(tags)
+
+
+def record_http(status, request_bytes, response_bytes, retries):
+    """Called by http_client after each request; adds to every open span on this thread."""
+    with _count_lock:
+        for s in _stack():
+            if s.done: continue
+            s.http_calls += 1
+            s.status = status
+            s.retries += retries
+            s.request_bytes += request_bytes
+            s.response_bytes += response_bytes
+
+
+def record_response_bytes(response_bytes):
+    """Body bytes read later from a streamed response (http_client cannot count them up front)."""
+    with _count_lock:
+        for s in _stack():
+            if not s.done: s.response_bytes += response_bytes
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def summary():
+    """One row per span name: count, p50/p95/p99 (seconds, rolling window) and totals."""
+    rows = []
+    with _lock:
+        for name in sorted(_totals):
+            values = sorted(_windows[name])
+            t = _totals[name]
+            rows.append({
+                "span": name, "count": t["count"],
+                "p50": _percentile(values, 0.50), "p95": _percentile(values, 0.95), "p99": _percentile(values, 0.99),
+                "errors": t["errors"], "retries": t["retries"],
+                "request_bytes": t["request_bytes"], "response_bytes": t["response_bytes"],
+                "seconds": t["seconds"],
+            })
+    return rows
+
+
+def export_jsonl():
+    """The most recent spans (up to MAX_SPANS) as JSON lines."""
+    with _lock:
+        spans = list(_spans)
+    return "".join(json.dumps(s.as_dict(), ensure_ascii=False) + "\n" for s in spans)
+
+
+def export_prometheus():
+    """summary() in Prometheus text exposition format."""
+    rows = summary()
+    lines = [
+        f"# HELP {METRIC_PREFIX}_duration_seconds Helper call latency (rolling window of {WINDOW}).",
+        f"# TYPE {METRIC_PREFIX}_duration_seconds summary",
+    ]
+    for r in rows:
+        label = r["span"].replace("\\", "\\\\").replace('"', '\\"')
+        for q, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+            lines.append(f'{METRIC_PREFIX}_duration_seconds{{span="{label}",quantile="{q}"}} {r[key]:.6f}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_sum{{span="{label}"}} {r["seconds"]:.6f}')
+        lines.append(f'{METRIC_PREFIX}_duration_seconds_count{{span="{label}"}} {r["count"]}')
+    for metric, key, help_text in (
+        ("errors_total", "errors", "Helper calls that returned or raised an error."),
+        ("retries_total", "retries", "HTTP retries made inside the helper."),
+        ("request_bytes_total", "request_bytes", "HTTP request body bytes sent."),
+        ("response_bytes_total", "response_bytes", "HTTP response body bytes received."),
+    ):
+        lines.append(f"# HELP {METRIC_PREFIX}_{metric} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{metric} counter")
+        for r in rows:
+            label = r["span"].replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'{METRIC_PREFIX}_{metric}{{span="{label}"}} {r[key]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,92 @@
+"""Upload one image to many Shopify products: details -> SEO -> upload, pipelined.
+
+The details of every target come from one bulk metadata lookup (or, if GraphQL
+is not available, from REST per target on the SEO threads). SEO text (Gemini)
+runs on SEO_WORKERS threads, and each target's upload starts as soon as its SEO is
+ready, on UPLOAD_WORKERS threads, so Gemini and Shopify work overlap. Every
+Shopify call still waits for room in the shop's leaky bucket (http_client);
+UPLOAD_WORKERS keeps one big upload from taking the whole bucket from other sessions.
+
+status is {product_id: {"stage", "title", "filename", "alt", "error"}} and is
+updated in place as each target moves on, so the page can show it while the job runs.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import output_variants
+from helpers import generate_seo_data, get_product_details_rest, get_products, upload_image_to_shopify
+
+SEO_WORKERS = 4
+UPLOAD_WORKERS = 2   # staged upload = 2 Shopify Admin calls ต่อ target
+
+PENDING, SEO, UPLOADING, DONE, FAILED = "pending", "seo", "uploading", "done", "failed"
+
+
+def split_ids(value):
+    """Product IDs from text separated by spaces, commas, "|" or new lines; duplicates dropped."""
+    return list(dict.fromkeys(x for x in value.replace("|", " ").replace(",", " ").split() if x))
+
+
+def new_status(product_ids):
+    return {pid: {"stage": PENDING, "title": "", "filename": "", "alt": "", "error": None} for pid in product_ids}
+
+
+def upload_to_targets(api_key, shop_url, access_token, image_bytes, product_ids, status=None, variant=output_variants.ORIGINAL):
+    """Returns (status, error); error says how many targets failed, status has the reason per target.
+
+    variant is the output_variants encoding uploaded to every target; it is encoded once, up front.
+    """
+    status = status if status is not None else new_status(product_ids)
+    for pid in product_ids:
+        status.setdefault(pid, new_status([pid])[pid])
+    lock = threading.Lock()
+
+    def update(pid, **fields):
+        with lock:
+            status[pid].update(fields)
+
+    if variant != output_variants.ORIGINAL:
+        output_variants.get(image_bytes, variant)  # encode ครั้งเดียว ทุก target อ่านจาก cache
+    products, lookup_err = get_products(shop_url, access_token, product_ids)
+
+    def upload(pid, filename, alt):
+        update(pid, stage=UPLOADING, filename=filename, alt=alt)
+        try:
+            ok, resp = upload_image_to_shopify(shop_url, access_token, pid, image_bytes, filename, alt, variant=variant)
+        except Exception as e:
+            ok, resp = False, str(e)
+        if ok: update(pid, stage=DONE)
+        else: update(pid, stage=FAILED, error=f"Upload failed: {resp}")
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload") as uploads:
+        def seo(pid, product):
+            if product is None:
+                # GraphQL ใช้ไม่ได้ -> ดึง title/handle ทีละ target ผ่าน REST (ใน SEO pool เลย ไม่ต้องรอครบทุกตัว)
+                title, handle = get_product_details_rest(shop_url, access_token, pid)
+                if title is None:
+                    update(pid, stage=FAILED, error=f"Product lookup failed: {lookup_err}")
+                    return
+                product = {"title": title, "handle": handle}
+            update(pid, stage=SEO, title=product["title"])
+            try:
+                seo_data = generate_seo_data(api_key, image_bytes, product["title"], product["handle"])
+            except Exception:
+                seo_data = {}
+            # SEO ล้มเหลว -> ใช้ชื่อจาก handle/title เหมือน flow เดิม แล้ว upload ต่อ
+            filename = seo_data.get("filename", f"{product['handle']}.jpg")
+            alt = seo_data.get("alt_text", product["title"])
+            if variant != output_variants.ORIGINAL:
+                filename = f"{os.path.splitext(filename)[0]}.{output_variants.extension(variant)}"
+            uploads.submit(upload, pid, filename, alt)
+
+        with ThreadPoolExecutor(max_workers=min(SEO_WORKERS, max(1, len(product_ids))), thread_name_prefix="seo") as seos:
+            for pid in product_ids:
+                product = products.get(pid)
+                if product or lookup_err: seos.submit(seo, pid, product)
+                else: update(pid, stage=FAILED, error="Product ID not found in Shopify")
+
+    failed = sum(1 for pid in product_ids if status[pid]["stage"] != DONE)
+    if failed == len(product_ids):
+        return None, f"All {failed} uploads failed"
+    return status, f"{failed}/{len(product_ids)} uploads failed" if failed else None